@@ -27,8 +27,6 @@ mysql = MySQL()
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
-    app.config["SESSION_PERMANENT"] = False
-    app.config["SESSION_TYPE"] = "filesystem"
     app.config['MYSQL_DATABASE_HOST'] = 'localhost'
     app.config['MYSQL_DATABASE_USER'] = 'root'
     app.config['MYSQL_DATABASE_DB'] = 'utaut'
@@ -39,7 +37,9 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     bootstrap.init_app(app)
-    session.init_app(app)
+    # De sessies worden bewaard zoals ingesteld met SESSION_TYPE (zie "app/sessions.py").
+    from app.sessions import init_session_store
+    init_session_store(app)
     mysql.init_app(app)
 
     from app.auth import bp as auth_bp
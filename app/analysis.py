@@ -0,0 +1,589 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy import stats
+from plspm.plspm import Plspm
+
+
+# Berekeningen op de volledige itemmatrix (cases x items). Waar voorheen per paar items de covariantie en correlatie in
+# Python-lijsten werd uitgerekend, worden hier alle covarianties en correlaties in één keer met NumPy berekend. De
+# functies binnen "create_study/functions.py" en "models.py" maken hier gebruik van.
+
+
+class ItemCorrelations(object):
+    def __init__(self, items, n, means, covariance):
+        self.items = list(items)
+        self.n = n
+        self.means = means
+        self.covariance = covariance
+        # De varianties (diagonaal van de covariantiematrix) en de standaarddeviaties van ieder item.
+        self.variances = np.diag(covariance).copy()
+        self.standard_deviations = np.sqrt(self.variances)
+        # De correlatiematrix volgt direct uit de covariantiematrix: r_ij = cov_ij / (sd_i * sd_j).
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.correlation = covariance / np.outer(self.standard_deviations, self.standard_deviations)
+        np.fill_diagonal(self.correlation, 1.0)
+        self._positions = {item: position for position, item in enumerate(self.items)}
+
+    def __repr__(self):
+        return '<Item correlations {} items, {} cases>'.format(len(self.items), self.n)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        # De scores als float64 matrix. De covariantie wordt (net als voorheen) gedeeld door n en niet door n - 1.
+        scores = np.asarray(dataset, dtype=np.float64)
+        n = scores.shape[0]
+        means = scores.mean(axis=0)
+        centered = scores - means
+        covariance = centered.T @ centered / n
+
+        return cls(dataset.columns, n, means, covariance)
+
+    @classmethod
+    def from_moments(cls, items, n, sums, crossproducts):
+        # Dezelfde matrices, maar dan berekend uit de bijgehouden sommen en kruisproducten van de scores (zie
+        # "ResponseStatistics" in "models.py"), zonder de scores zelf opnieuw te lezen.
+        means = np.asarray(sums, dtype=np.float64) / n
+        covariance = np.asarray(crossproducts, dtype=np.float64) / n - np.outer(means, means)
+
+        return cls(items, n, means, covariance)
+
+    def positions(self, items):
+        return [self._positions[item] for item in items]
+
+    def indicator(self, partition):
+        # Een indicatormatrix (items x kernvariabelen) met een 1 als het item bij de kernvariabele hoort.
+        indicator = np.zeros((len(self.items), len(partition)))
+        for column, name in enumerate(partition):
+            indicator[self.positions(partition[name]), column] = 1
+        return indicator
+
+    def variance(self, items):
+        # De variantie van de som van de gegeven items (bij één item de variantie van dat item zelf).
+        indexes = self.positions(items)
+        return float(self.covariance[np.ix_(indexes, indexes)].sum())
+
+    def covariance_of(self, items):
+        # De covariantiematrix van de gegeven items, in de volgorde van "items" (zoals de items van een "PathModel").
+        indexes = self.positions(items)
+        return self.covariance[np.ix_(indexes, indexes)]
+
+    def covariance_between(self, item1, item2):
+        return float(self.covariance[self._positions[item1], self._positions[item2]])
+
+    def correlation_between(self, item1, item2):
+        return float(self.correlation[self._positions[item1], self._positions[item2]])
+
+    def covariance_frame(self):
+        return pd.DataFrame(self.covariance, index=self.items, columns=self.items)
+
+    def correlation_frame(self):
+        return pd.DataFrame(self.correlation, index=self.items, columns=self.items)
+
+    def lower_triangle(self):
+        # De weergave zoals die op de pagina's gebruikt wordt: per rij worden alle waarden vanaf de eerste correlatie
+        # van (afgerond) 1 leeg gelaten. Normaal gesproken is dat de diagonaal, waardoor alleen de onderste driehoek
+        # overblijft en dezelfde waarden niet twee keer gegeven worden.
+        not_valuable = np.logical_or.accumulate(np.round(self.correlation, 4) == 1, axis=1)
+        return pd.DataFrame(np.where(not_valuable, np.nan, self.correlation), index=self.items, columns=self.items)
+
+
+def htmt_ratios(correlations, partition):
+    # De Heterotrait-Monotrait Ratio voor alle paren kernvariabelen tegelijk. "partition" is een dictionary met per
+    # kernvariabele de bijbehorende items. Met een indicatormatrix (items x kernvariabelen) worden de sommen van de
+    # correlaties per blok in één matrixvermenigvuldiging berekend.
+    names = list(partition)
+    indicator = correlations.indicator(partition)
+    block_sums = indicator.T @ correlations.correlation @ indicator
+    sizes = indicator.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Heterotrait: het gemiddelde van alle correlaties tussen de items van twee kernvariabelen.
+        heterotrait = block_sums / np.outer(sizes, sizes)
+        # Monotrait: het gemiddelde van de correlaties tussen de eigen items, zonder de diagonaal (welke altijd 1 is).
+        monotrait = (np.diag(block_sums) - sizes) / (sizes * (sizes - 1))
+        ratios = heterotrait / np.sqrt(np.outer(monotrait, monotrait))
+    # De ratio van een kernvariabele met zichzelf is altijd 1.
+    np.fill_diagonal(ratios, 1.0)
+
+    return pd.DataFrame(ratios, index=names, columns=names)
+
+
+def cronbachs_alphas(correlations, partition):
+    # Cronbach's Alpha voor alle kernvariabelen tegelijk. Per kernvariabele is de variantie van de "totaal"kolom (per
+    # case de scores opgeteld) de som van het bijbehorende blok van de covariantiematrix, en de som van de
+    # itemvarianties de som van de diagonaal binnen dat blok.
+    indicator = correlations.indicator(partition)
+    variance_total_columns = np.diag(indicator.T @ correlations.covariance @ indicator)
+    variance_questions = indicator.T @ correlations.variances
+    total_items = indicator.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alphas = (total_items / (total_items - 1)) * (
+                (variance_total_columns - variance_questions) / variance_total_columns)
+
+    return pd.Series(alphas, index=list(partition))
+
+
+def outer_vifs(correlations, partition):
+    # De VIF-waarden van de items. Binnen een kernvariabele is de VIF van een item gelijk aan het diagonaalelement van
+    # de inverse van de correlatiematrix van de items binnen die kernvariabele. Door de correlaties tussen items van
+    # verschillende kernvariabelen op 0 te zetten ontstaat een blokdiagonale matrix, waarvan de inverse in één keer de
+    # VIF-waarden van alle kernvariabelen geeft.
+    items = [item for name in partition for item in partition[name]]
+    positions = correlations.positions(items)
+    indicator = correlations.indicator(partition)[positions]
+    block_diagonal = correlations.correlation[np.ix_(positions, positions)] * (indicator @ indicator.T)
+
+    try:
+        vifs = np.diag(np.linalg.inv(block_diagonal))
+    except np.linalg.LinAlgError:
+        # Als items binnen een kernvariabele perfect samenhangen is de matrix niet inverteerbaar; de VIF-waarden van
+        # die kernvariabele zijn dan oneindig.
+        vifs = np.concatenate([_block_vifs(correlations, partition[name]) for name in partition])
+
+    return pd.Series(vifs, index=items)
+
+
+def _block_vifs(correlations, items):
+    positions = correlations.positions(items)
+    try:
+        return np.diag(np.linalg.inv(correlations.correlation[np.ix_(positions, positions)]))
+    except np.linalg.LinAlgError:
+        return np.full(len(items), np.inf)
+
+
+def inner_vifs(scores, path):
+    # De VIF-waarden van de latente variabelen. Per beïnvloede kernvariabele (een rij in de padmatrix) worden de
+    # VIF-waarden van de beïnvloedende kernvariabelen berekend uit de correlaties tussen hun scores.
+    correlation = scores.corr()
+    vifs = {}
+    for influenced in path.index:
+        influencers = [influencer for influencer in path.columns if path.loc[influenced, influencer] == 1]
+        if len(influencers) == 0:
+            continue
+        block = correlation.loc[influencers, influencers].values
+        try:
+            vifs[influenced] = pd.Series(np.diag(np.linalg.inv(block)), index=influencers)
+        except np.linalg.LinAlgError:
+            vifs[influenced] = pd.Series(np.inf, index=influencers)
+
+    return vifs
+
+
+class PathModel(object):
+    # Een snelle schatting van het structurele model (centroid-schema, Mode A, zoals binnen "Plspm") die alleen de
+    # covariantiematrix van de items gebruikt. Alle stappen van het PLS-algoritme (gewichten, scores, correlaties tussen
+    # de latente variabelen) zijn uit te drukken in de covariantiematrix, waardoor een bootstrap-steekproef niet als
+    # nieuwe dataset opgebouwd hoeft te worden maar alleen als gewogen covariantiematrix.
+    def __init__(self, items, partition, path, iterations=100, tolerance=0.000001):
+        self.items = list(items)
+        self.partition = partition
+        self.path = path
+        self.lvs = list(path.columns)
+        positions = {item: position for position, item in enumerate(self.items)}
+        # Outer design matrix (items x latente variabelen) met een 1 als het item bij de latente variabele hoort.
+        self.odm = np.zeros((len(self.items), len(self.lvs)))
+        for column, lv in enumerate(self.lvs):
+            self.odm[[positions[item] for item in partition[lv]], column] = 1
+        links = path.values
+        self.adjacency = links + links.T
+        # Per beïnvloede latente variabele de posities van de beïnvloedende latente variabelen.
+        self.predictors = {target: np.flatnonzero(links[target]) for target in range(len(self.lvs))
+                           if links[target].sum() > 0}
+        self.relations = [(self.lvs[influencer], self.lvs[target])
+                          for target, influencers in self.predictors.items() for influencer in influencers]
+        self.iterations = iterations
+        self.tolerance = tolerance
+
+    def __repr__(self):
+        return '<Path model {}>'.format(', '.join(self.lvs))
+
+    def weights(self, covariance, n):
+        # De buitengewichten worden iteratief geschat; gestart wordt met een gewicht van 1 voor ieder item. Net als
+        # binnen "Plspm" worden de scores geschaald met de correctie n / (n - 1), zodat de convergentie gelijk verloopt.
+        correction = n / (n - 1)
+        weights = self.odm / np.sqrt(np.diag(self.odm.T @ covariance @ self.odm))
+        old = weights.sum(axis=1)
+        for iteration in range(self.iterations):
+            lv_covariance = weights.T @ covariance @ weights
+            deviations = np.sqrt(np.diag(lv_covariance))
+            lv_correlation = lv_covariance / np.outer(deviations, deviations)
+            inner_weights = np.sign(lv_correlation * self.adjacency)
+            # Mode A: de covariantie van de items met de (via de binnengewichten) gecombineerde scores.
+            weights = self.odm * (covariance @ weights @ (inner_weights / (correction * deviations[:, np.newaxis])))
+            new = weights.sum(axis=1)
+            convergence = np.sum(np.square(np.abs(old) - np.abs(new)))
+            old = new
+            if convergence < self.tolerance:
+                break
+        else:
+            raise ValueError('Could not converge after {} iterations'.format(self.iterations))
+        weights = weights / np.sqrt(np.diag(weights.T @ covariance @ weights))
+
+        # Het teken van iedere latente variabele wordt zo gekozen dat de meeste items positief met de scores correleren.
+        # Net als binnen "Plspm" tellen hierbij alle items mee en niet alleen de items van de latente variabele zelf.
+        item_covariance = covariance @ weights
+        signs = np.where(np.sum(np.copysign(1.0, item_covariance), axis=0) < 0, -1.0, 1.0)
+        return weights * signs
+
+    def correlations(self, covariance, n):
+        # De correlatiematrix van de scores van de latente variabelen.
+        weights = self.weights(covariance, n)
+        lv_covariance = weights.T @ covariance @ weights
+        deviations = np.sqrt(np.diag(lv_covariance))
+        return lv_covariance / np.outer(deviations, deviations)
+
+    def estimate(self, covariance, n):
+        # De padcoëfficiënten (doel x voorspeller, zoals de padmatrix) en de R² per latente variabele, berekend met
+        # een regressie op de correlaties tussen de scores.
+        correlation = self.correlations(covariance, n)
+        coefficients = np.zeros_like(correlation)
+        r_squared = np.zeros(len(self.lvs))
+        for target, influencers in self.predictors.items():
+            betas = np.linalg.solve(correlation[np.ix_(influencers, influencers)], correlation[influencers, target])
+            coefficients[target, influencers] = betas
+            r_squared[target] = betas @ correlation[influencers, target]
+        return coefficients, r_squared
+
+    def without(self, influencer, target):
+        # Hetzelfde model zonder de gegeven relatie. Latente variabelen die daardoor geen relaties meer hebben (en hun
+        # items) vallen weg.
+        path = self.path.copy()
+        path.loc[target, influencer] = 0
+        connected = (path.sum(axis=0) + path.sum(axis=1)) > 0
+        path = path.loc[connected, connected]
+        partition = {lv: self.partition[lv] for lv in path.columns}
+        items = [item for item in self.items if any(item in partition[lv] for lv in partition)]
+        return PathModel(items, partition, path, self.iterations, self.tolerance)
+
+    def relation_values(self, coefficients):
+        # De padcoëfficiënten in de volgorde van "relations".
+        return np.concatenate([coefficients[target, influencers] for target, influencers in self.predictors.items()])
+
+    def relation_estimates(self, covariance, n):
+        coefficients, _ = self.estimate(covariance, n)
+        return self.relation_values(coefficients)
+
+
+def effect_size_batch(model, covariance, n, relations):
+    # De R² van de beïnvloede latente variabele wanneer het model zonder de relatie opnieuw geschat wordt, voor een
+    # batch relaties. Uitgevoerd binnen een procesworker (zie "AnalysisContext.effect_size_batches").
+    r_squared = []
+    for influencer, target in relations:
+        reduced = model.without(influencer, target)
+        if target not in reduced.lvs or len(reduced.predictors) == 0:
+            r_squared.append(0.0)
+            continue
+        positions = [model.items.index(item) for item in reduced.items]
+        _, reduced_r_squared = reduced.estimate(covariance[np.ix_(positions, positions)], n)
+        r_squared.append(reduced_r_squared[reduced.lvs.index(target)])
+    return np.array(r_squared)
+
+
+def bootstrap_batch(model, data, seed, samples):
+    # Eén batch bootstrap-steekproeven, uitgevoerd binnen een procesworker. Iedere batch heeft een eigen "seed" (zie
+    # "bootstrap_seeds"), waardoor de uitkomst niet afhangt van het aantal workers of de volgorde waarin batches
+    # klaar zijn. Een steekproef trekt n cases met teruglegging; hoe vaak iedere case getrokken is wordt als gewicht
+    # gebruikt om de covariantiematrix van de steekproef te berekenen.
+    random = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+    estimates = np.full((samples, len(model.relations)), np.nan)
+    for sample in range(samples):
+        counts = random.multinomial(n, np.full(n, 1.0 / n))
+        means = counts @ data / n
+        covariance = (data.T * counts) @ data / n - np.outer(means, means)
+        try:
+            estimates[sample] = model.relation_estimates(covariance, n)
+        except (ValueError, np.linalg.LinAlgError):
+            # Steekproeven die niet te schatten zijn (bijvoorbeeld een item zonder variantie) tellen niet mee.
+            continue
+    return estimates
+
+
+def bootstrap_seeds(seed, batches):
+    return np.random.SeedSequence(seed).spawn(batches)
+
+
+def bootstrap_summary(model, original, estimates, confidence=0.95):
+    # De significantie van de padcoëfficiënten uit de (tot nu toe) berekende bootstrap-steekproeven: de standaardfout
+    # is de standaarddeviatie van de schattingen, t = schatting / standaardfout en het betrouwbaarheidsinterval volgt
+    # uit de percentielen van de schattingen.
+    estimates = estimates[~np.isnan(estimates).any(axis=1)]
+    samples = estimates.shape[0]
+    std_errors = estimates.std(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_values = np.abs(original / std_errors)
+    p_values = 2 * stats.t.sf(t_values, samples - 1)
+    lower, upper = np.percentile(estimates, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+    return pd.DataFrame({'from': [relation[0] for relation in model.relations],
+                         'to': [relation[1] for relation in model.relations],
+                         'estimate': original, 'std_error': std_errors, 't_value': t_values, 'p_value': p_values,
+                         'ci_lower': lower, 'ci_upper': upper, 'samples': samples})
+
+
+def grouped_matrix(dataset, labels, minimum_size):
+    # De responsmatrix (als float64) met de cases gesorteerd per groep, zodat iedere groep een aaneengesloten blok rijen
+    # is. Een groep is daarmee een slice (zonder kopie) van de gedeelde matrix. Groepen met minder dan "minimum_size"
+    # cases worden niet meegenomen.
+    labels = labels.reindex(dataset.index)
+    sizes = labels.value_counts(sort=False).sort_index()
+    included = [name for name in sizes.index if sizes[name] >= minimum_size]
+    excluded = [(name, int(sizes[name])) for name in sizes.index if sizes[name] < minimum_size]
+
+    rows = labels.isin(included).values
+    order = np.argsort(labels.values[rows], kind='stable')
+    matrix = np.ascontiguousarray(dataset.values[rows][order], dtype=np.float64)
+
+    groups = []
+    start = 0
+    for name in included:
+        groups.append((name, start, start + int(sizes[name])))
+        start += int(sizes[name])
+    return matrix, groups, excluded
+
+
+def _covariance(block):
+    n = block.shape[0]
+    means = block.mean(axis=0)
+    return block.T @ block / n - np.outer(means, means), n
+
+
+def group_fit(data, model, start, stop):
+    # De schatting van het model binnen één groep (rijen "start" tot "stop" van de gedeelde matrix).
+    covariance, n = _covariance(data[start:stop])
+    coefficients, r_squared = model.estimate(covariance, n)
+    return model.relation_values(coefficients), r_squared
+
+
+def permutation_batch(data, model, first, second, seed, permutations):
+    # Eén batch permutaties voor het verschil in padcoëfficiënten tussen twee groepen. De cases van beide groepen
+    # worden willekeurig over de groepen verdeeld (met dezelfde groepsgroottes). Alleen de sommen en kruisproducten van
+    # de eerste groep worden per permutatie berekend; die van de tweede groep volgen uit die van beide groepen samen.
+    random = np.random.default_rng(seed)
+    pooled_block = np.concatenate([data[first[0]:first[1]], data[second[0]:second[1]]])
+    size = first[1] - first[0]
+    pooled = _moments(pooled_block)
+
+    differences = np.full((permutations, len(model.relations)), np.nan)
+    for permutation in range(permutations):
+        first_moments = _moments(pooled_block[random.permutation(pooled[2])[:size]])
+        second_moments = (pooled[0] - first_moments[0], pooled[1] - first_moments[1], pooled[2] - size)
+        try:
+            estimates = [model.relation_estimates(_moment_covariance(*moments)[1], moments[2])
+                         for moments in (first_moments, second_moments)]
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        differences[permutation] = estimates[0] - estimates[1]
+    return differences
+
+
+def _moments(block):
+    return block.sum(axis=0), block.T @ block, block.shape[0]
+
+
+def _moment_covariance(sums, crossproducts, n):
+    means = sums / n
+    return means, crossproducts / n - np.outer(means, means)
+
+
+def micom_statistics(model, first, second, pooled, pooled_weights=None):
+    # De toetsgrootheden van MICOM (Henseler et al., 2016) per latente variabele voor twee groepen. "first", "second"
+    # en "pooled" zijn de sommen, kruisproducten en het aantal cases van de groepen en van beide groepen samen.
+    # - Compositional invariance: de correlatie tussen de scores op de samengevoegde data, berekend met de gewichten
+    #   van de eerste en van de tweede groep.
+    # - Equality of composite means and variances: het verschil in gemiddelde en de log van de verhouding van de
+    #   varianties van de (met de samengevoegde gewichten gestandaardiseerde) scores tussen de groepen.
+    means_first, covariance_first = _moment_covariance(*first)
+    means_second, covariance_second = _moment_covariance(*second)
+    pooled_means, pooled_covariance = _moment_covariance(*pooled)
+    if pooled_weights is None:
+        pooled_weights = model.weights(pooled_covariance, pooled[2])
+    weights_first = model.weights(covariance_first, first[2])
+    weights_second = model.weights(covariance_second, second[2])
+
+    # Het teken van de scores binnen een groep is een conventie (zie "PathModel.weights"); daarom telt alleen de
+    # grootte van de correlatie.
+    between = np.abs(np.diag(weights_first.T @ pooled_covariance @ weights_second))
+    variance_first = np.diag(weights_first.T @ pooled_covariance @ weights_first)
+    variance_second = np.diag(weights_second.T @ pooled_covariance @ weights_second)
+    correlations = between / np.sqrt(variance_first * variance_second)
+
+    deviations = np.sqrt(np.diag(pooled_weights.T @ pooled_covariance @ pooled_weights))
+    mean_differences = (means_first - means_second) @ pooled_weights / deviations
+    log_variance_ratios = np.log(np.diag(pooled_weights.T @ covariance_first @ pooled_weights) /
+                                 np.diag(pooled_weights.T @ covariance_second @ pooled_weights))
+
+    return np.concatenate([correlations, mean_differences, log_variance_ratios])
+
+
+def micom_batch(data, model, first, second, seed, permutations):
+    # Eén batch permutaties voor MICOM. De gewichten op de samengevoegde data veranderen niet door het permuteren en
+    # worden één keer per batch berekend; per permutatie worden de buitengewichten van beide groepen opnieuw geschat.
+    random = np.random.default_rng(seed)
+    pooled_block = np.concatenate([data[first[0]:first[1]], data[second[0]:second[1]]])
+    size = first[1] - first[0]
+    pooled = _moments(pooled_block)
+    pooled_weights = model.weights(_moment_covariance(*pooled)[1], pooled[2])
+
+    statistics = np.full((permutations, 3 * len(model.lvs)), np.nan)
+    for permutation in range(permutations):
+        first_moments = _moments(pooled_block[random.permutation(pooled[2])[:size]])
+        second_moments = (pooled[0] - first_moments[0], pooled[1] - first_moments[1], pooled[2] - size)
+        try:
+            statistics[permutation] = micom_statistics(model, first_moments, second_moments, pooled, pooled_weights)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+    return statistics
+
+
+def micom_summary(model, observed, permuted):
+    # De uitkomst van MICOM per latente variabele: stap 2 is voldaan als de correlatie niet kleiner is dan het 5%
+    # kwantiel van de permutaties, stap 3 als het verschil in gemiddelden en de log van de verhouding van de varianties
+    # binnen het 95% interval van de permutaties vallen.
+    permuted = permuted[~np.isnan(permuted).any(axis=1)]
+    lvs = len(model.lvs)
+    correlations, mean_differences, log_variance_ratios = np.split(observed, 3)
+    quantiles = np.percentile(permuted[:, :lvs], 5, axis=0)
+    mean_lower, mean_upper = np.percentile(permuted[:, lvs:2 * lvs], [2.5, 97.5], axis=0)
+    variance_lower, variance_upper = np.percentile(permuted[:, 2 * lvs:], [2.5, 97.5], axis=0)
+
+    return pd.DataFrame({
+        'correlation': correlations, 'correlation_quantile': quantiles,
+        'correlation_p_value': ((permuted[:, :lvs] <= correlations).sum(axis=0) + 1) / (permuted.shape[0] + 1),
+        'compositional': correlations >= quantiles,
+        'mean_difference': mean_differences, 'mean_lower': mean_lower, 'mean_upper': mean_upper,
+        'equal_means': (mean_differences >= mean_lower) & (mean_differences <= mean_upper),
+        'log_variance_ratio': log_variance_ratios, 'variance_lower': variance_lower, 'variance_upper': variance_upper,
+        'equal_variances': (log_variance_ratios >= variance_lower) & (log_variance_ratios <= variance_upper),
+    }, index=model.lvs)
+
+
+def permutation_p_values(observed, permuted):
+    # Het aandeel permutaties met een (absoluut) verschil minstens zo groot als het waargenomen verschil.
+    permuted = permuted[~np.isnan(permuted).any(axis=1)]
+    exceeding = (np.abs(permuted) >= np.abs(observed)).sum(axis=0)
+    return (exceeding + 1) / (permuted.shape[0] + 1)
+
+
+class AnalysisContext(object):
+    # Alle berekeningen van één dataset binnen één versie van het onderzoeksmodel. Het PLS-PM model wordt één keer
+    # geschat; de ladingen, gewichten en scores van de latente variabelen worden hier bewaard zodat AVE, Composite
+    # Reliability en de ladingen per kernvariabele opgezocht kunnen worden in plaats van steeds opnieuw berekend.
+    def __init__(self, dataset, configuration, scheme, partition, correlations=None):
+        self.dataset = dataset
+        self.configuration = configuration
+        self.scheme = scheme
+        self.partition = partition
+        if correlations is None:
+            correlations = ItemCorrelations.from_dataset(dataset)
+        self.correlations = correlations
+
+        self.plspm = Plspm(dataset, configuration, scheme)
+        outer_model = self.plspm.outer_model()
+        self.loadings = outer_model['loading']
+        self.weights = outer_model['weight']
+        self.scores = self.plspm.scores()
+        self.cronbachs_alphas = cronbachs_alphas(self.correlations, partition)
+        self.outer_vifs = outer_vifs(self.correlations, partition)
+        self.inner_vifs = inner_vifs(self.scores, configuration.path())
+
+        # Het structurele model: de padcoëfficiënten (doel x voorspeller) en de R² uit dezelfde schatting. De f² waarden
+        # vragen om een nieuwe schatting per relatie en worden daarom apart berekend (zie "effect_size_batches").
+        self.path_model = PathModel(dataset.columns, partition, configuration.path())
+        self.path_coefficients = self.plspm.path_coefficients()
+        inner_summary = self.plspm.inner_summary()
+        self.r_squared = inner_summary['r_squared']
+        self.r_squared_adj = inner_summary['r_squared_adj']
+        self.f_squares = None
+
+    def __repr__(self):
+        return '<Analysis context {}>'.format(', '.join(self.partition))
+
+    def effect_size_batches(self):
+        # De argumenten voor "effect_size_batch": één batch per beïnvloede latente variabele, met alle relaties
+        # naar die latente variabele.
+        batches = {}
+        for influencer, target in self.path_model.relations:
+            batches.setdefault(target, []).append((influencer, target))
+        # De covariantiematrix in de volgorde van de items van het model (de kolommen van de dataset).
+        covariance = self.correlations.covariance_of(self.path_model.items)
+        return [(self.path_model, covariance, self.correlations.n, relations) for relations in batches.values()]
+
+    def set_effect_sizes(self, batches, results):
+        # f² = (R² met de relatie - R² zonder de relatie) / (1 - R² met de relatie).
+        self.f_squares = {}
+        for (_, _, _, relations), excluded in zip(batches, results):
+            for (influencer, target), r_squared_excluded in zip(relations, excluded):
+                r_squared = self.r_squared[target]
+                self.f_squares[(influencer, target)] = float((r_squared - r_squared_excluded) / (1 - r_squared))
+
+    def report(self):
+        # Alle uitkomsten van de analyse als tabellen (naam -> DataFrame), voor het exporteren van een rapport.
+        names = list(self.partition)
+        frames = OrderedDict()
+        frames['Construct reliability'] = pd.DataFrame({
+            'AVE': [self.average_variance_extracted(name) for name in names],
+            "Cronbach's alpha": [self.cronbachs_alpha(name) for name in names],
+            'Composite reliability': [self.composite_reliability(name) for name in names]}, index=names)
+        frames['Loadings'] = pd.DataFrame({'loading': self.loadings, 'weight': self.weights})
+        frames['HTMT'] = htmt_ratios(self.correlations, self.partition)
+        frames['Outer VIF'] = self.outer_vifs.to_frame('VIF')
+        frames['Inner VIF'] = pd.DataFrame([(influencer, influenced, vif) for influenced in self.inner_vifs
+                                            for influencer, vif in self.inner_vifs[influenced].items()],
+                                           columns=['from', 'to', 'VIF'])
+        frames['Path coefficients'] = self.path_coefficients
+        frames['R-square'] = pd.DataFrame({'R-square': self.r_squared, 'R-square adjusted': self.r_squared_adj})
+        frames['F-square'] = pd.DataFrame([(influencer, target, f_square) for (influencer, target), f_square
+                                           in (self.f_squares or {}).items()], columns=['from', 'to', 'F-square'])
+        frames['Item correlations'] = self.correlations.correlation_frame()
+        return frames
+
+    def path_coefficient(self, influencer, target):
+        return float(self.path_coefficients.loc[target, influencer])
+
+    def loadings_of(self, abbreviation):
+        return self.loadings[self.partition[abbreviation]]
+
+    def average_variance_extracted(self, abbreviation):
+        # Het gemiddelde van de gekwadrateerde ladingen.
+        loadings = self.loadings_of(abbreviation).values
+        return float(np.mean(loadings * loadings))
+
+    def cronbachs_alpha(self, abbreviation):
+        return float(self.cronbachs_alphas[abbreviation])
+
+    def composite_reliability(self, abbreviation):
+        # (som ladingen)^2 / ((som ladingen)^2 + som errors), met als error per item 1 - lading^2.
+        loadings = self.loadings_of(abbreviation).values
+        squared_sum = loadings.sum() * loadings.sum()
+        errors = (1 - loadings * loadings).sum()
+        return float(squared_sum / (squared_sum + errors))
+
+
+# De versie van "AnalysisContext". Deze maakt deel uit van de sleutel van een analyse, zodat opgeslagen contexten van
+# een eerdere versie (zonder de nieuwere attributen) niet hergebruikt worden.
+CONTEXT_VERSION = 2
+
+# De analysecontexten die al berekend zijn, met als sleutel de vragenlijst, de versie van de data en het model. Alleen
+# de laatst gebruikte contexten worden bewaard.
+MAX_CONTEXTS = 8
+_contexts = OrderedDict()
+_contexts_lock = threading.Lock()
+
+
+def cached_context(key):
+    with _contexts_lock:
+        if key in _contexts:
+            _contexts.move_to_end(key)
+            return _contexts[key]
+
+
+def cache_context(key, context):
+    with _contexts_lock:
+        _contexts[key] = context
+        while len(_contexts) > MAX_CONTEXTS:
+            _contexts.popitem(last=False)
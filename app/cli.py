@@ -1,6 +1,52 @@
 import os
+import random
+import statistics
+import threading
+import time
+import uuid
 
 import click
+from sqlalchemy import event
+from app import db
+from app.completions import complete_case, drain_completions, pending_completions, retry_failed_completions
+from app.export import generate_csv, write_xlsx
+from app.models import Study, Questionnaire, QuestionGroup, Question, Case, QuestionAnswer, DemographicAnswer, \
+    ResponseStatistics
+
+
+# De code van de wegwerpvragenlijsten (en de sessie van hun cases) van "flask benchmark completions".
+BENCHMARK_PREFIX = 'benchmark-'
+
+
+def benchmark_questionnaire(questionnaire):
+    # Een kopie van de vragenlijst met dezelfde schaal, vragenlijstgroepen en vragen, zonder onderzoek.
+    copy = Questionnaire(code='{}{}'.format(BENCHMARK_PREFIX, uuid.uuid4().hex[:16]), scale=questionnaire.scale)
+    db.session.add(copy)
+    db.session.flush()
+    for questiongroup in questionnaire.linked_questiongroups:
+        group = QuestionGroup(questionnaire_id=copy.id, corevariable_id=questiongroup.corevariable_id)
+        db.session.add(group)
+        db.session.flush()
+        for question in questiongroup.linked_questions():
+            db.session.add(Question(question=question.question, question_code=question.question_code,
+                                    reversed_score=question.reversed_score, questiongroup_id=group.id,
+                                    corevariable_id=question.corevariable_id))
+    db.session.commit()
+    return copy
+
+
+def remove_benchmark_questionnaire(questionnaire):
+    # Het verwijderen van een wegwerpvragenlijst met alle cases, antwoorden en statistieken.
+    case_ids = db.session.query(Case.id).filter(Case.questionnaire_id == questionnaire.id)
+    group_ids = db.session.query(QuestionGroup.id).filter(QuestionGroup.questionnaire_id == questionnaire.id)
+    QuestionAnswer.query.filter(QuestionAnswer.case_id.in_(case_ids)).delete(synchronize_session=False)
+    DemographicAnswer.query.filter(DemographicAnswer.case_id.in_(case_ids)).delete(synchronize_session=False)
+    Case.query.filter_by(questionnaire_id=questionnaire.id).delete(synchronize_session=False)
+    ResponseStatistics.query.filter_by(questionnaire_id=questionnaire.id).delete(synchronize_session=False)
+    Question.query.filter(Question.questiongroup_id.in_(group_ids)).delete(synchronize_session=False)
+    QuestionGroup.query.filter_by(questionnaire_id=questionnaire.id).delete(synchronize_session=False)
+    Questionnaire.query.filter_by(id=questionnaire.id).delete(synchronize_session=False)
+    db.session.commit()
 
 
 def register(app):
@@ -34,3 +80,204 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def export():
+        """Export commands."""
+        pass
+
+    @export.command()
+    @click.argument('study_code')
+    @click.argument('path')
+    @click.option('--format', 'file_format', type=click.Choice(['csv', 'xlsx']), default='csv')
+    def responses(study_code, path, file_format):
+        """Export the responses of a study as CSV or XLSX."""
+        study = Study.query.filter_by(code=study_code).first()
+        if study is None:
+            raise click.ClickException('Study {} does not exist'.format(study_code))
+        questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+        if file_format == 'csv':
+            with open(path, 'w', newline='', encoding='utf-8') as file:
+                for chunk in generate_csv(questionnaire):
+                    file.write(chunk)
+        else:
+            write_xlsx(questionnaire, path)
+        click.echo('Exported the responses of {} to {}'.format(study_code, path))
+
+    @app.cli.group()
+    def completions():
+        """Completion queue commands."""
+        pass
+
+    @completions.command()
+    @click.option('--retry-failed', is_flag=True, help='Also retry the completions that failed before.')
+    def drain(retry_failed):
+        """Write all queued completions to the database."""
+        if not app.config['COMPLETION_QUEUE']:
+            raise click.ClickException('COMPLETION_QUEUE is not configured')
+        if retry_failed:
+            retry_failed_completions()
+        flushed = drain_completions()
+        pending, failed = pending_completions()
+        click.echo('Processed {} queued completions, {} failed'.format(flushed, failed))
+        if failed:
+            raise click.ClickException('{} completions could not be written; see the error column of the queue'.format(
+                failed))
+
+    @app.cli.group()
+    def sessions():
+        """Session store commands."""
+        pass
+
+    @sessions.command()
+    def gc():
+        """Remove the expired sessions from the session store."""
+        if not hasattr(app.session_interface, 'collect_garbage'):
+            raise click.ClickException('SESSION_TYPE {} removes expired sessions itself'.format(
+                app.config['SESSION_TYPE']))
+        removed = app.session_interface.collect_garbage(app)
+        click.echo('Removed {} expired sessions, {} left'.format(removed, app.session_interface.count_sessions(app)))
+
+    @app.cli.group()
+    def benchmark():
+        """Benchmark commands."""
+        pass
+
+    @benchmark.command()
+    @click.argument('study_code')
+    @click.option('--cases', default=50, type=click.IntRange(min=1), help='The number of synthetic cases to complete.')
+    def completions(study_code, cases):
+        """Complete synthetic cases on a copy of a study's questionnaire and report the commits per completion."""
+        study = Study.query.filter_by(code=study_code).first()
+        if study is None:
+            raise click.ClickException('Study {} does not exist'.format(study_code))
+        # De cases worden voltooid binnen een wegwerpkopie van de vragenlijst, zodat de data en de statistieken van het
+        # onderzoek zelf nooit veranderen, ook niet als de benchmark onderbroken wordt. Kopieën die na een onderbreking
+        # zijn blijven staan worden eerst opgeruimd.
+        for leftover in Questionnaire.query.filter(Questionnaire.code.like(BENCHMARK_PREFIX + '%')).all():
+            remove_benchmark_questionnaire(leftover)
+        original = Questionnaire.query.filter_by(study_id=study.id).first()
+        questionnaire = benchmark_questionnaire(original)
+        questions = questionnaire.linked_questions()
+        demographics = [demographic for demographic in original.linked_demographics]
+
+        # Het tellen van de commits en de SQL statements tijdens het voltooien, via de events van de engine.
+        counts = {'commits': 0, 'statements': 0}
+
+        def count_commit(connection):
+            counts['commits'] += 1
+
+        def count_statement(connection, cursor, statement, parameters, context, executemany):
+            counts['statements'] += 1
+
+        event.listen(db.engine, 'commit', count_commit)
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        per_completion, duration, duplicates = [], 0.0, 0
+        try:
+            for _ in range(cases):
+                case = Case(session='{}{}'.format(BENCHMARK_PREFIX, uuid.uuid4()), questionnaire_id=questionnaire.id)
+                db.session.add(case)
+                db.session.commit()
+                scores = {question.id: random.randint(1, questionnaire.scale) for question in questions}
+                demographic_answers = [(demographic.id, None) for demographic in demographics]
+
+                commits, statements = counts['commits'], counts['statements']
+                start = time.perf_counter()
+                complete_case(case, questionnaire, scores, demographic_answers)
+                duration += time.perf_counter() - start
+                per_completion.append((counts['commits'] - commits, counts['statements'] - statements))
+
+                # Een tweede keer verzenden mag niets opnieuw opslaan.
+                if complete_case(case, questionnaire, scores, demographic_answers):
+                    duplicates += 1
+        finally:
+            event.remove(db.engine, 'commit', count_commit)
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+            db.session.rollback()
+            remove_benchmark_questionnaire(questionnaire)
+
+        commits = [commit for commit, _ in per_completion]
+        statements = [statement for _, statement in per_completion]
+        click.echo('{} completions of {} answers, {:.2f} ms per completion'.format(
+            cases, len(questions) + len(demographics), 1000 * duration / cases))
+        click.echo('Commits per completion: mean {:.2f}, max {}'.format(statistics.mean(commits), max(commits)))
+        click.echo('Statements per completion: mean {:.2f}, max {}'.format(statistics.mean(statements),
+                                                                          max(statements)))
+        click.echo('Duplicate submissions stored: {}'.format(duplicates))
+
+    @benchmark.command()
+    @click.option('--participants', default=20, help='The number of participants filling in at the same time.')
+    @click.option('--requests', 'requests_per_participant', default=50, help='The number of requests per participant.')
+    @click.option('--questions', default=40, help='The number of questions of the synthetic questionnaire.')
+    def sessions(participants, requests_per_participant, questions):
+        """Measure the session read and write latency of the session store under concurrent participants."""
+        interface = app.session_interface
+        cookie_name = app.session_cookie_name
+        timings = {'read': [], 'write': []}
+        timings_lock = threading.Lock()
+        errors = []
+
+        def request_session(cookie, change):
+            # Eén verzoek van een participant: de sessie openen en (gewijzigd of niet) weer opslaan, zoals Flask dat
+            # aan het begin en einde van ieder verzoek doet. Returnt de cookie voor het volgende verzoek.
+            headers = {'Cookie': '{}={}'.format(cookie_name, cookie)} if cookie else {}
+            with app.test_request_context('/', headers=headers) as context:
+                start = time.perf_counter()
+                stored = interface.open_session(app, context.request)
+                read = time.perf_counter() - start
+                change(stored)
+                response = app.response_class()
+                start = time.perf_counter()
+                interface.save_session(app, stored, response)
+                write = time.perf_counter() - start
+            with timings_lock:
+                timings['read'].append(read)
+                timings['write'].append(write)
+            for header in response.headers.getlist('Set-Cookie'):
+                name, _, value = header.split(';')[0].partition('=')
+                if name == cookie_name:
+                    return value
+            return cookie
+
+        def participant():
+            # Een participant zoals in de vragenlijst: het starten (de demografieken en lege scores), daarna om en om
+            # een onderdeel openen (alleen lezen) en beantwoorden (de scores wijzigen), en tot slot het voltooien.
+            try:
+                def start(stored):
+                    stored['user'] = str(uuid.uuid4())
+                    stored['study'] = 'benchmark'
+                    stored['demographic_answers'] = [(1, 'answer'), (2, None)]
+                    stored['question_scores'] = bytes(questions)
+
+                def answer(stored):
+                    scores = bytearray(stored['question_scores'])
+                    scores[random.randrange(questions)] = random.randint(1, 7)
+                    stored['question_scores'] = bytes(scores)
+
+                cookie = request_session(None, start)
+                for number in range(requests_per_participant):
+                    cookie = request_session(cookie, answer if number % 2 else lambda stored: None)
+                request_session(cookie, lambda stored: stored.clear())
+            except Exception as error:
+                errors.append(error)
+
+        before = interface.count_sessions(app) if hasattr(interface, 'count_sessions') else None
+        threads = [threading.Thread(target=participant) for _ in range(participants)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        if errors:
+            raise click.ClickException('{} participants failed: {!r}'.format(len(errors), errors[0]))
+
+        click.echo('{} store, {} participants, {} requests: {:.0f} requests per second'.format(
+            app.config['SESSION_TYPE'], participants, len(timings['read']), len(timings['read']) / duration))
+        for operation in ('read', 'write'):
+            milliseconds = sorted(1000 * timing for timing in timings[operation])
+            click.echo('{:<5} p50 {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms'.format(
+                operation, statistics.median(milliseconds), milliseconds[int(0.95 * (len(milliseconds) - 1))],
+                milliseconds[-1]))
+        if before is not None:
+            click.echo('Sessions in the store: {} before, {} after'.format(before, interface.count_sessions(app)))
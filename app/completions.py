@@ -0,0 +1,196 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.models import Questionnaire, Case, QuestionAnswer, DemographicAnswer, ResponseStatistics
+
+
+# Het opslaan van voltooide vragenlijsten, direct (zie "complete_case") of uitgesteld. Als "COMPLETION_QUEUE" ingesteld
+# is, wordt een voltooide case eerst in een lokaal SQLite-bestand (in WAL-modus) gezet, waarna de participant direct een
+# bevestiging krijgt. Een thread op de achtergrond schrijft de cases vervolgens in batches (één transactie per batch)
+# naar de database. Een case blijft in de wachtrij staan totdat de transactie in de database geslaagd is; na een crash
+# worden de overgebleven cases dus alsnog opgeslagen. Omdat een case alleen voltooid wordt als deze dat nog niet was
+# (zie "mark_completed" hieronder), wordt een case die al opgeslagen was maar nog in de wachtrij stond overgeslagen.
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def mark_completed(case_id):
+    # Het markeren van een case als voltooid, maar alleen als deze dat nog niet was. Returnt of de case nu voltooid is
+    # gemarkeerd; bij twee keer voltooien (of gelijktijdig voltooien) is dat maar één keer het geval.
+    completed = db.session.execute(
+        db.update(Case).where(Case.id == case_id, Case.completed.isnot(True)).values(completed=True)
+        .execution_options(synchronize_session=False))
+    return completed.rowcount > 0
+
+
+def insert_answers(completions):
+    # Het opslaan van de antwoorden van één of meer cases, per soort met één bulk insert. "completions" is een lijst
+    # met (case-ID, scores, demografische antwoorden), zoals bij "complete_case".
+    question_answers = [{'score': int(score), 'question_id': question_id, 'case_id': case_id}
+                        for case_id, scores, _ in completions for question_id, score in scores.items()]
+    demographic_answers = [{'answer': answer, 'demographic_id': demographic_id, 'case_id': case_id}
+                           for case_id, _, answers in completions for demographic_id, answer in answers]
+    if len(question_answers) > 0:
+        db.session.execute(db.insert(QuestionAnswer), question_answers)
+    if len(demographic_answers) > 0:
+        db.session.execute(db.insert(DemographicAnswer), demographic_answers)
+
+
+def complete_case(case, questionnaire, scores, demographic_answers):
+    # Het voltooien van een case binnen één transactie: het markeren van de case als voltooid, het opslaan van alle
+    # antwoorden (per soort met één bulk insert) en het bijwerken van de statistieken van de vragenlijst (zie
+    # "ResponseStatistics"). "scores" is een dictionary met de vraag-ID als key en de score als waarde,
+    # "demographic_answers" een lijst met (demografiek-ID, antwoord). De case wordt alleen voltooid als deze dat nog niet
+    # was; bij twee keer verzenden wordt de tweede keer niets opgeslagen en wordt False gereturned.
+    if not mark_completed(case.id):
+        db.session.rollback()
+        return False
+
+    insert_answers([(case.id, scores, demographic_answers)])
+    statistics = ResponseStatistics.for_questionnaire(questionnaire)
+    statistics.add_case(scores)
+    db.session.commit()
+
+    return True
+
+
+
+def queue_connection(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=FULL')
+    connection.execute('CREATE TABLE IF NOT EXISTS completion (id INTEGER PRIMARY KEY, case_id INTEGER UNIQUE, '
+                       'questionnaire_id INTEGER, payload TEXT, created REAL, error TEXT)')
+    return connection
+
+
+def enqueue_completion(case_id, questionnaire_id, scores, demographic_answers):
+    # Het toevoegen van een voltooide case aan de wachtrij. Een case die al in de wachtrij staat (bijvoorbeeld door twee
+    # keer verzenden) wordt niet nogmaals toegevoegd.
+    payload = json.dumps({'scores': scores, 'demographic_answers': demographic_answers})
+    connection = queue_connection(current_app.config['COMPLETION_QUEUE'])
+    try:
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO completion (case_id, questionnaire_id, payload, created) '
+                               'VALUES (?, ?, ?, ?)', (case_id, questionnaire_id, payload, time.time()))
+    finally:
+        connection.close()
+    start_flusher(current_app._get_current_object())
+
+
+def _load(payload):
+    # JSON kent alleen tekst als key; de vraag-IDs worden weer getallen.
+    completion = json.loads(payload)
+    return ({int(question_id): score for question_id, score in completion['scores'].items()},
+            [tuple(answer) for answer in completion['demographic_answers']])
+
+
+def _store(rows):
+    # Het opslaan van een batch cases uit de wachtrij binnen één transactie. Returnt het aantal voltooide cases.
+    completions = []
+    statistics = {}
+    for (_, case_id, questionnaire_id, payload) in rows:
+        if not mark_completed(case_id):
+            continue
+        scores, demographic_answers = _load(payload)
+        completions.append((case_id, scores, demographic_answers))
+        if questionnaire_id not in statistics:
+            statistics[questionnaire_id] = ResponseStatistics.for_questionnaire(
+                Questionnaire.query.get(questionnaire_id))
+        statistics[questionnaire_id].add_case(scores)
+    insert_answers(completions)
+    db.session.commit()
+    return len(completions)
+
+
+def flush_completions(batch_size=None):
+    # Het opslaan van (maximaal) één batch uit de wachtrij. Returnt het aantal verwerkte rijen uit de wachtrij. Als de
+    # batch als geheel niet opgeslagen kan worden, wordt iedere case los opgeslagen; een case die dan nog steeds niet
+    # opgeslagen kan worden blijft met de foutmelding in de wachtrij staan en houdt de rest niet tegen. Als de database
+    # niet bereikbaar is, blijft alles zonder foutmelding staan voor een volgende poging.
+    batch_size = batch_size or current_app.config['COMPLETION_BATCH_SIZE']
+    connection = queue_connection(current_app.config['COMPLETION_QUEUE'])
+    try:
+        rows = connection.execute('SELECT id, case_id, questionnaire_id, payload FROM completion WHERE error IS NULL '
+                                  'ORDER BY id LIMIT ?', (batch_size,)).fetchall()
+        if len(rows) == 0:
+            return 0
+
+        try:
+            _store(rows)
+            with connection:
+                connection.executemany('DELETE FROM completion WHERE id = ?', [(row[0],) for row in rows])
+        except Exception:
+            db.session.rollback()
+            for row in rows:
+                try:
+                    _store([row])
+                    with connection:
+                        connection.execute('DELETE FROM completion WHERE id = ?', (row[0],))
+                except OperationalError:
+                    # De database is (tijdelijk) niet bereikbaar: alles blijft in de wachtrij staan.
+                    db.session.rollback()
+                    raise
+                except Exception:
+                    db.session.rollback()
+                    with connection:
+                        connection.execute('UPDATE completion SET error = ? WHERE id = ?',
+                                           (traceback.format_exc(), row[0]))
+        return len(rows)
+    finally:
+        connection.close()
+
+
+def drain_completions():
+    # Het opslaan van alle cases in de wachtrij. Returnt het aantal verwerkte rijen.
+    total = 0
+    while True:
+        flushed = flush_completions()
+        if flushed == 0:
+            return total
+        total += flushed
+
+
+def pending_completions():
+    # Het aantal cases in de wachtrij en het aantal daarvan dat niet opgeslagen kon worden.
+    connection = queue_connection(current_app.config['COMPLETION_QUEUE'])
+    try:
+        return connection.execute('SELECT COUNT(*), COUNT(error) FROM completion').fetchone()
+    finally:
+        connection.close()
+
+
+def retry_failed_completions():
+    connection = queue_connection(current_app.config['COMPLETION_QUEUE'])
+    try:
+        with connection:
+            return connection.execute('UPDATE completion SET error = NULL WHERE error IS NOT NULL').rowcount
+    finally:
+        connection.close()
+
+
+def start_flusher(app):
+    # De thread die de wachtrij op de achtergrond leegt, één per proces.
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_forever, args=(app,), name='completion-flusher', daemon=True)
+            _flusher.start()
+
+
+def _flush_forever(app):
+    while True:
+        time.sleep(app.config['COMPLETION_FLUSH_INTERVAL'])
+        with app.app_context():
+            try:
+                drain_completions()
+            except Exception:
+                app.logger.exception('Writing the completion queue to the database failed')
+            finally:
+                db.session.remove()
@@ -47,6 +47,11 @@ class CreateNewRelationForm(FlaskForm):
     submit = SubmitField('Create relation')
 
 
+class MultiGroupAnalysisForm(FlaskForm):
+    demographic = SelectField(u'Compare the groups of demographic', coerce=int)
+    submit = SubmitField('Compare groups')
+
+
 class CreateNewDemographicForm(FlaskForm):
     style_name = {'style': 'width:175%;'}
     name_of_demographic = StringField('Name of the demographic (max. 40 characters)',
@@ -1,13 +1,21 @@
-from app.models import  Study, ResearchModel, Questionnaire, QuestionGroup, CoreVariable, Relation, Question, QuestionAnswer
+from app.models import  Study, ResearchModel, Questionnaire, QuestionGroup, CoreVariable, Relation, Question, QuestionAnswer, \
+    Case, ResponseStatistics, RelationSignificance, Demographic, DemographicAnswer, AnalysisJob
 from app import db
+from hashlib import md5
+import glob
+import os
 import plspm.config as c
-from plspm.plspm import Plspm
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
+from plspm.scheme import Scheme
+from plspm.mode import Mode
 import math
 import pandas as pd
 import numpy as np
-from flask import render_template, flash, redirect, url_for, request
+from app.analysis import ItemCorrelations, AnalysisContext, PathModel, cached_context, cache_context, htmt_ratios, \
+    bootstrap_batch, bootstrap_seeds, bootstrap_summary, effect_size_batch, grouped_matrix, group_fit, \
+    permutation_batch, permutation_p_values, micom_batch, micom_statistics, micom_summary, CONTEXT_VERSION
+from app.export import write_report
+from app.jobs import enqueue_job, run_batches
+from flask import render_template, flash, redirect, url_for, request, current_app
 from flask_login import current_user, login_required
 
 
@@ -61,20 +69,473 @@ def setup_structure_dataframe(list_of_corevariables, model_id):
     return structure
 
 
-def return_questionlist_and_answerlist(list_of_questiongroups):
-    list_of_questions = []
-    list_of_answers = []
+def return_questions(questionnaire):
+    # De ID's en codes van de vragen van de vragenlijst (in de volgorde van de vragenlijstgroepen) met één query.
+    return db.session.query(Question.id, Question.question_code).join(
+        QuestionGroup, Question.questiongroup_id == QuestionGroup.id).filter(
+        QuestionGroup.questionnaire_id == questionnaire.id).order_by(QuestionGroup.id, Question.id).all()
+
+
+def return_response_matrix(questionnaire):
+    # De vragen van de vragenlijst en alle antwoorden van de voltooide cases, elk met één query.
+    questions = return_questions(questionnaire)
+    answers = db.session.query(QuestionAnswer.case_id, QuestionAnswer.question_id, QuestionAnswer.score).join(
+        Case, QuestionAnswer.case_id == Case.id).filter(
+        Case.questionnaire_id == questionnaire.id, Case.completed.is_(True), QuestionAnswer.score.isnot(None)).all()
+
+    list_of_questions = [question_code for (question_id, question_code) in questions]
+    columns = {question_id: column for column, (question_id, question_code) in enumerate(questions)}
+    answers = np.array([(case_id, columns[question_id], score) for (case_id, question_id, score) in answers
+                        if question_id in columns], dtype=np.int64).reshape(-1, 3)
+
+    # De antwoorden worden omgezet in een matrix (cases x items) met een rij per case-ID. De scores liggen tussen 1 en
+    # 10 en passen daardoor in één byte (uint8); een 0 betekent dat er geen antwoord is.
+    case_ids, rows = np.unique(answers[:, 0], return_inverse=True)
+    scores = np.zeros((len(case_ids), len(list_of_questions)), dtype=np.uint8)
+    scores[rows, answers[:, 1]] = answers[:, 2]
+
+    # Alleen cases waarbij alle vragen beantwoord zijn worden gebruikt.
+    complete = (scores > 0).all(axis=1)
+    if not complete.all():
+        case_ids, scores = case_ids[complete], scores[complete]
+
+    # De Pandas Dataframe gebruikt de matrix zelf (zonder kopie) met de vraagcodes als kolommen en de case-ID's als index.
+    return pd.DataFrame(scores, index=pd.Index(case_ids, name='case_id'), columns=list_of_questions, copy=False)
+
+
+def pivot_answers(case_ids, answers, columns):
+    # Zet (case_id, kolom-ID, waarde) rijen om naar één rij per case (in de volgorde van "case_ids") met de waarden in
+    # de volgorde van "columns". Ontbrekende antwoorden blijven None, zodat iedere waarde altijd onder de juiste kop
+    # staat.
+    positions = {column: position for position, column in enumerate(columns)}
+    rows = {case_id: [None] * len(columns) for case_id in case_ids}
+    for case_id, column, value in answers:
+        if case_id in rows and column in positions:
+            rows[case_id][positions[column]] = value
+
+    return [(case_id, rows[case_id]) for case_id in case_ids]
+
+
+def return_result_chunk(questionnaire, questions, demographics, after=0, limit=100):
+    # Een deel van de tabellen met de demografische antwoorden en de vragenlijstantwoorden: de eerste "limit" voltooide
+    # cases met een ID groter dan "after" (keyset-paginering op Case.id), met één query per soort antwoord. Daarnaast
+    # wordt het ID gereturned waarna het volgende deel begint, of None als er geen cases meer zijn.
+    case_ids = [case_id for (case_id,) in db.session.query(Case.id).filter(
+        Case.questionnaire_id == questionnaire.id, Case.completed.is_(True), Case.id > after).order_by(
+        Case.id).limit(limit)]
+    if len(case_ids) == 0:
+        return [], [], None
+
+    cases = db.and_(Case.questionnaire_id == questionnaire.id, Case.completed.is_(True),
+                    Case.id.between(case_ids[0], case_ids[-1]))
+    demographic_answers = db.session.query(
+        DemographicAnswer.case_id, DemographicAnswer.demographic_id, DemographicAnswer.answer).join(
+        Case, DemographicAnswer.case_id == Case.id).filter(cases)
+    question_answers = db.session.query(QuestionAnswer.case_id, QuestionAnswer.question_id, QuestionAnswer.score).join(
+        Case, QuestionAnswer.case_id == Case.id).filter(cases)
+
+    return (pivot_answers(case_ids, demographic_answers, [demographic.id for demographic in demographics]),
+            pivot_answers(case_ids, question_answers, [question.id for question in questions]),
+            case_ids[-1] if len(case_ids) == limit else None)
+
+
+def stream_template(template_name, **context):
+    # Zoals "render_template", maar de pagina wordt in delen naar de browser gestuurd zodra deze gerenderd zijn, zodat
+    # de browser direct kan beginnen met het tonen ervan.
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+
+def question_descriptives(questionnaire):
+    # Per vraag van de vragenlijst (vraag-ID als sleutel) het aantal antwoorden, het gemiddelde, de standaarddeviatie,
+    # het minimum, het maximum en de frequenties per schaalpunt. Alles volgt uit de frequenties, die met één
+    # gegroepeerde query (per vraag en score het aantal antwoorden) opgehaald worden.
+    questions = return_questions(questionnaire)
+    frequencies = db.session.query(
+        QuestionAnswer.question_id, QuestionAnswer.score, db.func.count(QuestionAnswer.id)).join(
+        Question, QuestionAnswer.question_id == Question.id).join(
+        QuestionGroup, Question.questiongroup_id == QuestionGroup.id).filter(
+        QuestionGroup.questionnaire_id == questionnaire.id, QuestionAnswer.score.isnot(None)).group_by(
+        QuestionAnswer.question_id, QuestionAnswer.score).all()
+
+    # Een tabel (vragen x scores) met de frequenties; kolom 0 blijft leeg omdat de schaal bij 1 begint.
+    rows = {question_id: row for row, (question_id, _) in enumerate(questions)}
+    scale = max([questionnaire.scale or 0] + [score for (_, score, _) in frequencies])
+    table = np.zeros((len(questions), scale + 1), dtype=np.int64)
+    for question_id, score, count in frequencies:
+        table[rows[question_id], score] = count
+
+    scores = np.arange(scale + 1)
+    counts = table.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = table @ scores / counts
+        # De standaarddeviatie van de populatie (zoals "np.std"), gedeeld door n.
+        deviations = np.sqrt(table @ (scores * scores) / counts - averages * averages)
+
+    descriptives = {}
+    for (question_id, _), row, count, average, deviation in zip(questions, table, counts, averages, deviations):
+        answered = np.flatnonzero(row)
+        descriptives[question_id] = {
+            'count': int(count),
+            'average': round(float(average), 2) if count > 0 else None,
+            'standard_deviation': round(float(deviation), 2) if count > 0 else None,
+            'minimum': int(answered[0]) if count > 0 else None,
+            'maximum': int(answered[-1]) if count > 0 else None,
+            'frequencies': [int(frequency) for frequency in row[1:]]}
+
+    return descriptives
+
+
+def return_item_correlations(questionnaire, dataset):
+    # De correlaties worden berekend uit de bijgehouden statistieken van de vragenlijst (zie "ResponseStatistics"). Als
+    # deze niet (meer) overeenkomen met de dataset, bijvoorbeeld bij een vragenlijst van voor het bijhouden ervan, worden
+    # ze eenmalig opnieuw opgebouwd vanuit de dataset.
+    statistics = ResponseStatistics.query.filter_by(questionnaire_id=questionnaire.id).first()
+    question_ids = {question_code: question_id for (question_id, question_code) in return_questions(questionnaire)}
+    # Ook de volgorde van de vragen moet gelijk zijn aan die van de kolommen van de dataset.
+    if statistics is None or statistics.n != len(dataset.index) or \
+            statistics.question_ids() != [question_ids[question_code] for question_code in dataset.columns]:
+        # Eerst wordt (in een nieuwe transactie) de rij vergrendeld en pas daarna de dataset opnieuw gelezen. Een case die
+        # tegelijk voltooid wordt zit dan al in de dataset (en de statistieken), of wacht op de vergrendeling en wordt
+        # daarna opgeteld; nooit dubbel of helemaal niet.
+        db.session.commit()
+        statistics = ResponseStatistics.for_questionnaire(questionnaire)
+        dataset = return_response_matrix(questionnaire)
+        statistics.rebuild([question_ids[question_code] for question_code in dataset.columns], dataset.values)
+        db.session.commit()
 
-    for questiongroup in list_of_questiongroups:
-        questions = [question for question in Question.query.filter_by(questiongroup_id=questiongroup.id)]
-        for question in questions:
-            list_of_questions.append(question.question_code)
-            answers_question = []
-            for answer in [answer for answer in QuestionAnswer.query.filter_by(question_id=question.id)]:
-                answers_question.append(answer.score)
-            list_of_answers.append(answers_question)
+    return statistics.item_correlations()
+
+
+def analysis_key(questionnaire, model):
+    # De sleutel van een analyse: de analyse wordt alleen opnieuw uitgevoerd als de data (voltooide cases) of het model
+    # (de relaties) veranderd is.
+    relations = tuple(sorted((relation.influencer_id, relation.influenced_id)
+                             for relation in Relation.query.filter_by(model_id=model.id)))
+    key = '{}/{}/{}/{}/{}'.format(questionnaire.id, model.id, relations, questionnaire.data_version(), CONTEXT_VERSION)
+
+    return md5(key.encode('utf-8')).hexdigest()
+
+
+def build_analysis_context(job, questionnaire_id, model_id):
+    # Deze functie wordt op de achtergrond uitgevoerd (zie "app/jobs.py").
+    questionnaire = Questionnaire.query.get(questionnaire_id)
+    model = ResearchModel.query.get(model_id)
+    corevariables = [corevariable for corevariable in model.linked_corevariables]
+
+    # Het opzetten van de dataframe (gebruik van plspm package en pd.dataframe met de vragenlijstresultaten)
+    job.update_progress(0.1, 'Loading responses')
+    df = return_response_matrix(questionnaire)
+    correlations = return_item_correlations(questionnaire, df)
+
+    structure = setup_structure_dataframe(corevariables, model.id)
+    config = c.Config(structure.path(), scaled=False)
+    for corevariable in corevariables:
+        config.add_lv_with_columns_named(corevariable.abbreviation, Mode.A, df, corevariable.abbreviation)
+
+    job.update_progress(0.3, 'Estimating the PLS path model')
+    context = AnalysisContext(df, config, Scheme.CENTROID, corevariable_partition(corevariables, df), correlations)
+
+    # De f² waarden: per beïnvloede kernvariabele een batch met het opnieuw schatten van het model zonder telkens één
+    # van de relaties, parallel over de procesworkers.
+    job.update_progress(0.7, 'Calculating the effect sizes')
+    batches = context.effect_size_batches()
+    results = [None] * len(batches)
+    run_batches(effect_size_batch, batches, results.__setitem__)
+    context.set_effect_sizes(batches, results)
+
+    return context
+
+
+def setup_analysis_context(study):
+    # De analysecontext (de dataframe, de correlatiematrix en het één keer geschatte PLS-PM model). Als deze nog niet
+    # berekend is wordt een job op de achtergrond gestart; in dat geval wordt (None, job) gereturned zodat de pagina
+    # de voortgang kan tonen.
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    model = ResearchModel.query.filter_by(id=study.researchmodel_id).first()
+    key = analysis_key(questionnaire, model)
+
+    context = cached_context(key)
+    if context is not None:
+        return context, None
+
+    job = enqueue_job('analysis', key, questionnaire.id, build_analysis_context, questionnaire.id, model.id)
+    if not job.is_finished():
+        return None, job
+
+    context = job.load_result()
+    cache_context(key, context)
+
+    return context, job
+
+
+def report_path(questionnaire_id, key, file_format):
+    return os.path.join(current_app.config['REPORT_FOLDER'], '{}_{}.{}'.format(questionnaire_id, key, file_format))
+
+
+def build_analysis_report(job, questionnaire_id, model_id, key, file_format):
+    # Het rapport met alle uitkomsten van de analyse, op de achtergrond geschreven (zie "app/jobs.py"). Een context die
+    # al berekend is (in dit proces of door een afgeronde analysejob) wordt hergebruikt.
+    context = cached_context(key)
+    if context is None:
+        analysis_job = AnalysisJob.query.filter_by(kind='analysis', key=key, status='finished').order_by(
+            AnalysisJob.id.desc()).first()
+        if analysis_job is not None:
+            context = analysis_job.load_result()
+        else:
+            context = build_analysis_context(job, questionnaire_id, model_id)
+
+    job.update_progress(0.9, 'Writing the report')
+    frames = context.report()
+    significances = RelationSignificance.query.filter_by(questionnaire_id=questionnaire_id, key=key).all()
+    if len(significances) > 0:
+        frames['Path significance'] = pd.DataFrame([{
+            'relation': significance.return_relation(), 'estimate': significance.estimate,
+            'std_error': significance.std_error, 't_value': significance.t_value, 'p_value': significance.p_value,
+            'ci_lower': significance.ci_lower, 'ci_upper': significance.ci_upper, 'samples': significance.samples}
+            for significance in significances])
+
+    # Rapporten van een eerdere versie van de data of het model worden niet meer gedownload en worden verwijderd.
+    path = report_path(questionnaire_id, key, file_format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_report(frames, path, file_format)
+    for old_path in glob.glob(report_path(questionnaire_id, '*', file_format)):
+        if old_path != path:
+            os.remove(old_path)
+
+    return path
+
+
+def setup_analysis_report(study, file_format):
+    # Het pad van het rapport voor de huidige data en het huidige model. Een rapport dat al geschreven is wordt direct
+    # gereturned, zonder iets opnieuw te berekenen; anders wordt het op de achtergrond geschreven en wordt (None, job)
+    # gereturned.
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    model = ResearchModel.query.filter_by(id=study.researchmodel_id).first()
+    key = analysis_key(questionnaire, model)
+    path = report_path(questionnaire.id, key, file_format)
+    if os.path.exists(path):
+        return path, None
+
+    job_key = '{}.{}'.format(key, file_format)
+    job = enqueue_job('report', job_key, questionnaire.id, build_analysis_report, questionnaire.id, model.id, key,
+                      file_format)
+    if job.is_finished() and not os.path.exists(path):
+        # Het rapport van een afgeronde job is inmiddels verwijderd; het wordt opnieuw geschreven.
+        job.status = 'failed'
+        db.session.commit()
+        job = enqueue_job('report', job_key, questionnaire.id, build_analysis_report, questionnaire.id, model.id, key,
+                          file_format)
+    if not job.is_finished():
+        return None, job
+
+    return path, job
+
+
+def batch_sizes(total, batch_size):
+    return [batch_size] * (total // batch_size) + ([total % batch_size] if total % batch_size else [])
+
+
+def bootstrap_path_coefficients(job, questionnaire_id, model_id, key):
+    # De significantie van de padcoëfficiënten met bootstrapping, op de achtergrond uitgevoerd (zie "app/jobs.py"). De
+    # steekproeven worden in batches over de procesworkers verdeeld. Iedere batch krijgt een eigen, uit de sleutel van
+    # de analyse afgeleide seed, zodat dezelfde data en hetzelfde model altijd dezelfde uitkomst geven.
+    questionnaire = Questionnaire.query.get(questionnaire_id)
+    model = ResearchModel.query.get(model_id)
+    corevariables = [corevariable for corevariable in model.linked_corevariables]
+
+    job.update_progress(0.05, 'Loading responses')
+    df = return_response_matrix(questionnaire)
+    correlations = return_item_correlations(questionnaire, df)
+    structure = setup_structure_dataframe(corevariables, model.id)
+    path_model = PathModel(df.columns, corevariable_partition(corevariables, df), structure.path())
+    # De statistieken hebben een eigen volgorde van de items; het model volgt de kolommen van de dataset.
+    original = path_model.relation_estimates(correlations.covariance_of(path_model.items), correlations.n)
+
+    samples = current_app.config['BOOTSTRAP_SAMPLES']
+    batch_size = current_app.config['BOOTSTRAP_BATCH_SIZE']
+    sizes = batch_sizes(samples, batch_size)
+    seeds = bootstrap_seeds(int(key, 16), len(sizes))
+    data = df.values
+    estimates = [None] * len(sizes)
+
+    def batch_finished(index, batch_estimates):
+        # De tussentijdse betrouwbaarheidsintervallen over alle batches die tot nu toe klaar zijn.
+        estimates[index] = batch_estimates
+        finished = [batch for batch in estimates if batch is not None]
+        summary = bootstrap_summary(path_model, original, np.vstack(finished))
+        job.update_progress(0.05 + 0.9 * len(finished) / len(sizes), '{} of {} bootstrap samples'.format(
+            sum(len(batch) for batch in finished), samples), summary.round(4).to_dict('records'))
+
+    run_batches(bootstrap_batch, [(path_model, data, seed, size) for seed, size in zip(seeds, sizes)], batch_finished)
+
+    # De uiteindelijke uitkomst, in de volgorde van de batches, wordt per relatie opgeslagen.
+    summary = bootstrap_summary(path_model, original, np.vstack(estimates))
+    abbreviations = {corevariable.id: corevariable.abbreviation for corevariable in corevariables}
+    relations = {(abbreviations[relation.influencer_id], abbreviations[relation.influenced_id]): relation
+                 for relation in Relation.query.filter_by(model_id=model.id)}
+    RelationSignificance.query.filter_by(questionnaire_id=questionnaire.id).delete()
+    for row in summary.to_dict('records'):
+        db.session.add(RelationSignificance(
+            key=key, relation_id=relations[(row['from'], row['to'])].id, questionnaire_id=questionnaire.id,
+            estimate=float(row['estimate']), std_error=float(row['std_error']), t_value=float(row['t_value']),
+            p_value=float(row['p_value']), ci_lower=float(row['ci_lower']), ci_upper=float(row['ci_upper']),
+            samples=int(row['samples'])))
+    db.session.commit()
+
+    return summary
+
+
+def setup_path_significance(study):
+    # De opgeslagen significantie van de padcoëfficiënten voor de huidige data en het huidige model. Als deze er nog
+    # niet is wordt de bootstrap op de achtergrond gestart en wordt (None, job) gereturned.
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    model = ResearchModel.query.filter_by(id=study.researchmodel_id).first()
+    key = analysis_key(questionnaire, model)
+
+    significances = RelationSignificance.query.filter_by(questionnaire_id=questionnaire.id, key=key).all()
+    if len(significances) > 0:
+        return significances, None
+
+    job = enqueue_job('bootstrap', key, questionnaire.id, bootstrap_path_coefficients, questionnaire.id, model.id, key)
+    if not job.is_finished():
+        return None, job
+
+    return RelationSignificance.query.filter_by(questionnaire_id=questionnaire.id, key=key).all(), job
 
-    return list_of_questions, list_of_answers
+
+def return_demographic_labels(questionnaire, demographic):
+    # Per voltooide case (case_id als index) het antwoord op de demografische vraag, met één query.
+    answers = db.session.query(DemographicAnswer.case_id, DemographicAnswer.answer).join(
+        Case, DemographicAnswer.case_id == Case.id).filter(
+        Case.questionnaire_id == questionnaire.id, Case.completed.is_(True),
+        DemographicAnswer.demographic_id == demographic.id, DemographicAnswer.answer.isnot(None)).all()
+
+    return pd.Series({case_id: answer for (case_id, answer) in answers}, dtype=object)
+
+
+def setup_group_data(questionnaire, model, demographic):
+    # De gegevens voor het vergelijken van de groepen van een demografische vraag: het model (zie "PathModel") en één
+    # gedeelde matrix met de responsen, gesorteerd per groep. De groepen zijn slices van deze matrix.
+    corevariables = [corevariable for corevariable in model.linked_corevariables]
+    df = return_response_matrix(questionnaire)
+    labels = return_demographic_labels(questionnaire, demographic)
+    structure = setup_structure_dataframe(corevariables, model.id)
+    path_model = PathModel(df.columns, corevariable_partition(corevariables, df), structure.path())
+    matrix, groups, excluded = grouped_matrix(df, labels, current_app.config['MINIMUM_GROUP_SIZE'])
+
+    return path_model, matrix, groups, excluded
+
+
+def run_group_permutations(job, function, path_model, matrix, groups, key):
+    # De permutaties per paar groepen, in batches verdeeld over de procesworkers. Iedere batch heeft een eigen seed
+    # (afgeleid van de sleutel). Per paar worden de uitkomsten van alle batches samengevoegd.
+    pairs = [(first, second) for first in range(len(groups)) for second in range(first + 1, len(groups))]
+    sizes = batch_sizes(current_app.config['PERMUTATIONS'], current_app.config['PERMUTATION_BATCH_SIZE'])
+    seeds = bootstrap_seeds(int(key, 16), len(pairs) * len(sizes))
+    batches = [(path_model, groups[first][1:], groups[second][1:], seeds[number * len(sizes) + index], size)
+               for number, (first, second) in enumerate(pairs) for index, size in enumerate(sizes)]
+    permutations = [None] * len(batches)
+
+    def batch_finished(index, result):
+        permutations[index] = result
+        finished = len([batch for batch in permutations if batch is not None])
+        job.update_progress(0.15 + 0.8 * finished / len(batches),
+                            '{} of {} permutation batches'.format(finished, len(batches)))
+
+    job.update_progress(0.15, 'Permuting the groups')
+    run_batches(function, batches, batch_finished, shared=matrix)
+
+    return pairs, [np.vstack(permutations[number * len(sizes):(number + 1) * len(sizes)])
+                   for number in range(len(pairs))], sum(sizes)
+
+
+def multigroup_analysis(job, questionnaire_id, model_id, demographic_id, key):
+    # De vergelijking van het structurele model tussen de groepen van een demografische vraag, op de achtergrond
+    # uitgevoerd (zie "app/jobs.py"). Het model wordt per groep parallel geschat, waarna per paar groepen de verschillen
+    # in padcoëfficiënten getoetst worden met permutaties van de groepen.
+    model = ResearchModel.query.get(model_id)
+    demographic = Demographic.query.get(demographic_id)
+
+    job.update_progress(0.05, 'Loading responses')
+    path_model, matrix, groups, excluded = setup_group_data(Questionnaire.query.get(questionnaire_id), model,
+                                                            demographic)
+
+    job.update_progress(0.1, 'Estimating the model per group')
+    fits = [None] * len(groups)
+    run_batches(group_fit, [(path_model, start, stop) for (_, start, stop) in groups], fits.__setitem__, shared=matrix)
+
+    pairs, permutations, total = run_group_permutations(job, permutation_batch, path_model, matrix, groups, key)
+    comparisons = []
+    for (first, second), permuted in zip(pairs, permutations):
+        differences = fits[first][0] - fits[second][0]
+        comparisons.append({'groups': (groups[first][0], groups[second][0]),
+                            'differences': [round(float(value), 4) for value in differences],
+                            'p_values': [round(float(value), 4) for value in permutation_p_values(differences, permuted)]})
+
+    abbreviations = {corevariable.abbreviation: corevariable.name for corevariable in model.linked_corevariables}
+    return {'demographic': demographic.name,
+            'relations': ['{} ----> {}'.format(abbreviations[influencer], abbreviations[target])
+                          for (influencer, target) in path_model.relations],
+            'groups': [{'name': name, 'n': stop - start,
+                        'coefficients': [round(float(value), 4) for value in fit[0]],
+                        'r_squared': {abbreviations[path_model.lvs[target]]: round(float(fit[1][target]), 4)
+                                      for target in path_model.predictors}}
+                       for (name, start, stop), fit in zip(groups, fits)],
+            'comparisons': comparisons,
+            'excluded': excluded,
+            'permutations': total}
+
+
+def measurement_invariance(job, questionnaire_id, model_id, demographic_id, key):
+    # De meetinvariantie (MICOM) tussen de groepen van een demografische vraag, op de achtergrond uitgevoerd. Stap 1
+    # (configural invariance) is voldaan doordat iedere groep met dezelfde items, dezelfde behandeling van de data en
+    # hetzelfde algoritme geschat wordt; stap 2 en 3 worden per paar groepen getoetst met permutaties.
+    model = ResearchModel.query.get(model_id)
+    demographic = Demographic.query.get(demographic_id)
+
+    job.update_progress(0.05, 'Loading responses')
+    path_model, matrix, groups, excluded = setup_group_data(Questionnaire.query.get(questionnaire_id), model,
+                                                            demographic)
+
+    # De sommen en kruisproducten per groep worden één keer berekend en per paar hergebruikt.
+    job.update_progress(0.1, 'Estimating the outer weights per group')
+    moments = [(matrix[start:stop].sum(axis=0), matrix[start:stop].T @ matrix[start:stop], stop - start)
+               for (_, start, stop) in groups]
+
+    pairs, permutations, total = run_group_permutations(job, micom_batch, path_model, matrix, groups, key)
+    comparisons = []
+    for (first, second), permuted in zip(pairs, permutations):
+        pooled = tuple(moments[first][index] + moments[second][index] for index in range(3))
+        observed = micom_statistics(path_model, moments[first], moments[second], pooled)
+        summary = micom_summary(path_model, observed, permuted)
+        comparisons.append({'groups': (groups[first][0], groups[second][0]),
+                            'constructs': summary.round(4).to_dict('index')})
+
+    abbreviations = {corevariable.abbreviation: corevariable.name for corevariable in model.linked_corevariables}
+    return {'demographic': demographic.name,
+            'corevariables': [(lv, abbreviations[lv]) for lv in path_model.lvs],
+            'groups': [{'name': name, 'n': stop - start} for (name, start, stop) in groups],
+            'comparisons': comparisons,
+            'excluded': excluded,
+            'permutations': total}
+
+
+def setup_group_comparison(study, demographic, kind):
+    # De vergelijking tussen de groepen van een demografische vraag: "multigroup" (de padcoëfficiënten) of
+    # "invariance" (MICOM). Zolang deze op de achtergrond berekend wordt, wordt (None, job) gereturned.
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    model = ResearchModel.query.filter_by(id=study.researchmodel_id).first()
+    key = md5('{}/{}'.format(analysis_key(questionnaire, model), demographic.id).encode('utf-8')).hexdigest()
+    function = {'multigroup': multigroup_analysis, 'invariance': measurement_invariance}[kind]
+
+    job = enqueue_job(kind, key, questionnaire.id, function, questionnaire.id, model.id, demographic.id, key)
+    if not job.is_finished():
+        return None, job
+
+    return job.load_result(), job
 
 
 def indexes_questiongroups_three(list_of_questiongroups, questiongroup_id):
@@ -95,206 +556,89 @@ def indexes_questiongroups_three(list_of_questiongroups, questiongroup_id):
 
 # Berekeningen
 
-def variance(items, dataset):
-    # Als er één item is gegeven binnen de lijst (de variantie van één item wordt berekend).
-    if len(items) == 1:
-        # De item wordt gereturned met "item"
-        item = items[0]
-        scores = [score for score in dataset[item]]
-        average = sum(scores) / len(scores)
-        # Een lijst met de gekwadrateerde verschillen tussen de scores en de gemiddelde van de scores
-        differences_squared = [(score - average) * (score - average) for score in scores]
-
-        return sum(differences_squared) / (len(scores))
-
-    # Als er meerdere items gegeven zijn.
-    else:
-        scores_per_case = {}
-        scores = len([score for score in dataset[items[0]]])
-        for question in items:
-            for row in range(scores):
-                if row in scores_per_case:
-                    scores_per_case[row].append(dataset[question][row])
-                else:
-                    scores_per_case[row] = []
-                    scores_per_case[row].append(dataset[question][row])
-
-        list_of_totals = [sum(scores_per_case[case]) for case in scores_per_case]
-
-        average = sum(list_of_totals) / len(list_of_totals)
-        differences_squared = [(score - average) * (score - average) for score in list_of_totals]
-
-        return sum(differences_squared) / (len(list_of_totals))
-
-
-def cronbachs_alpha(corevariable, dataset):
-    abbreviation = corevariable.abbreviation
-    # Alle vragen binnen de kernvariabele.
-    questions = [i for i in [question for question in dataset if question[:len(abbreviation)] == abbreviation]]
-    total_items = len(questions)
-    # De variantie van de "totaal"kolom, oftewel per case de scores opgeteld.
-    variance_total_column = variance(questions, dataset)
-    # Een lijst met de varianties voor iedere item
-    variance_questions = [variance([question], dataset) for question in questions]
-
-    return (total_items / (total_items - 1)) * (
-            (variance_total_column - sum(variance_questions)) / variance_total_column)
-
-
-def composite_reliability(corevariable, dataset, configuration, scheme):
-    abbreviation = corevariable.abbreviation
-    plspm_calc = Plspm(dataset, configuration, scheme)
-    model = plspm_calc.outer_model()
-
-    # Dictionary met alleen loadings van kernvariabele (loadings_dct)
-    loadings_dct = pd.DataFrame(model['loading']).to_dict('dict')['loading']
-    questions = [question for question in loadings_dct if question[:len(abbreviation)] == abbreviation]
-    loadings_dct = {key: loadings_dct[key] for key in loadings_dct if key in questions}
-
-    # Lijst met de ladingen (loadings), lijst met de gekwadrateerde ladingen (loadings_squared) en lijst met de
-    # errors (errors).
-    loadings = [loadings_dct[i] for i in loadings_dct]
-    loadings_squared = [score * score for score in loadings]
-    errors = [1 - score for score in loadings_squared]
-
-    return (sum(loadings) * sum(loadings)) / ((sum(loadings) * sum(loadings)) + sum(errors))
-
-
-def average_variance_extracted(corevariable, dataset, configuration, scheme):
-    abbreviation = corevariable.abbreviation
-    plspm_calc = Plspm(dataset, configuration, scheme)
-    model = plspm_calc.outer_model()
-
-    # Dictionary met alleen loadings van latente variabele (loadings_dct)
-    loadings_dct = pd.DataFrame(model['loading']).to_dict('dict')['loading']
-    not_questions = [question for question in loadings_dct if question[:len(abbreviation)] == abbreviation]
-    loadings_dct = {key: loadings_dct[key] for key in loadings_dct if key in not_questions}
-
-    # Lijst met ladingen (loadings), lijst met gekwadrateerde ladingen (loadings_squared) en de populatie (oftewel
-    # hoeveel ladingen/items er zijn.
-    loadings = [loadings_dct[i] for i in loadings_dct]
-    loadings_squared = [score * score for score in loadings]
-    population = len(loadings)
-
-    return sum(loadings_squared) / population
-
-
-def covariance(item1, item2, dataset):
-    # De scores van de twee items.
-    scores_item1 = []
-    scores_item2 = []
-    # Deze if-statement komt alleen voor als de correlationmatrix wordt uitgerekend.
-    if item1 == item2:
-        for item in dataset:
-            if item == item1:
-                for score in dataset[item]:
-                    scores_item1.append(score)
-                    scores_item2.append(score)
-    else:
-        for item in dataset:
-            if item == item1:
-                for score in dataset[item]:
-                    scores_item1.append(score)
-            elif item == item2:
-                for score in dataset[item]:
-                    scores_item2.append(score)
-
-    # De gemiddelden van de items.
-    avg_item1 = sum(scores_item1) / len(scores_item1)
-    avg_item2 = sum(scores_item2) / len(scores_item2)
-
-    # Een zip met sublijsten voor iedere combinatie van item1 en item2 scores (combination_of_scores).
-    combination_of_scores = zip(scores_item1, scores_item2)
-    combination_of_differences = [(x - avg_item1, y - avg_item2) for (x, y) in tuple(combination_of_scores)]
-    differences_combined = [x * y for (x, y) in combination_of_differences]
-
-    return sum(differences_combined) / len(differences_combined)
-
-
-def pearson_correlation(lv1, lv2, dataset):
-    # De covariantie van de twee variabelen (covar) en de standaarddeviaties van beide variabelen.
-    covar = covariance(lv1, lv2, dataset)
-    sd_lv1 = math.sqrt(variance([lv1], dataset))
-    sd_lv2 = math.sqrt(variance([lv2], dataset))
+def variance(items, dataset, correlations=None):
+    # De variantie van één item, of bij meerdere items de variantie van de "totaal"kolom (per case de scores opgeteld).
+    # Deze volgt direct uit de covariantiematrix: de som van alle covarianties tussen de gegeven items.
+    if correlations is None:
+        correlations = ItemCorrelations.from_dataset(dataset[items])
 
-    return covar / (sd_lv1 * sd_lv2)
+    return correlations.variance(items)
 
 
-def correlation_matrix(dataset):
-    # Een dictionary met correlatiescores voor ieder item (data).
-    data = {}
-    items = [i for i in [item for item in dataset]]
-    for item in items:
-        data[item] = []
-        not_valuable = False
-        for lv2 in items:
-            if round(pearson_correlation(item, lv2, dataset), 4) == 1:
-                not_valuable = True
-            if not_valuable:
-                data[item].append(np.nan)
-            else:
-                data[item].append(pearson_correlation(item, lv2, dataset))
+def cronbachs_alpha(corevariable, context):
+    # Opgezocht in de analysecontext, waarbinnen Cronbach's Alpha voor alle kernvariabelen tegelijk berekend is.
+    return context.cronbachs_alpha(corevariable.abbreviation)
 
-    # Het omzetten van de dictionary naar een Pandas Dataframe en deze tabel omdraaien (met transpose).
-    df = pd.DataFrame(data, index=[item for item in items])
-    df = df.transpose()
 
-    return df
+def composite_reliability(corevariable, context):
+    # Opgezocht in de analysecontext, zie "setup_analysis_context".
+    return context.composite_reliability(corevariable.abbreviation)
+
+
+def average_variance_extracted(corevariable, context):
+    # Opgezocht in de analysecontext, zie "setup_analysis_context".
+    return context.average_variance_extracted(corevariable.abbreviation)
 
 
-def heterotrait_monotrait(var1, var2, corr_matrix, dataset):
-    # Twee lijsten met de items voor iedere variabele.
-    length_abbreviation_var1 = len(var1.abbreviation)
-    items_var1 = [i for i in [item for item in dataset if item[:length_abbreviation_var1] == var1.abbreviation]]
-    length_abbreviation_var2 = len(var2.abbreviation)
-    items_var2 = [i for i in [item for item in dataset if item[:length_abbreviation_var2] == var2.abbreviation]]
+def covariance(item1, item2, dataset, correlations=None):
+    if correlations is None:
+        correlations = ItemCorrelations.from_dataset(dataset[list(dict.fromkeys([item1, item2]))])
 
-    # De Monotrait lijsten bevatten de correlaties tussen de eigen items van een kernvariabele (oftewel bijv. de
-    # correlatie tussen PE1 en PE2, PE5 en PE3 etc.). De Heterotrait lijst bevat de correlaties tussen de items van de
-    # twee kernvariabelen (oftewel bijv. PE1 en EE3, PE4 en EE2 etc.).
-    monotrait_var1_list = []
-    monotrait_var2_list = []
-    heterotrait_list = []
+    return correlations.covariance_between(item1, item2)
 
-    # Het toevoegen van de correlaties tussen de items binnen de eerste kernvariabele.
-    for item_1 in items_var1:
-        for item_2 in corr_matrix[item_1].keys():
-            if item_2 in items_var1 and not math.isnan(corr_matrix[item_1][item_2]):
-                monotrait_var1_list.append(corr_matrix[item_1][item_2])
 
-    # Het toevoegen van de correlaties tussen de items binnen de tweede kernvariabele.
-    for item_1 in items_var2:
-        for item_2 in corr_matrix[item_1].keys():
-            if item_2 in items_var2 and not math.isnan(corr_matrix[item_1][item_2]):
-                monotrait_var2_list.append(corr_matrix[item_1][item_2])
+def pearson_correlation(lv1, lv2, dataset, correlations=None):
+    # De correlatie is de covariantie van de twee variabelen gedeeld door het product van beide standaarddeviaties.
+    if correlations is None:
+        correlations = ItemCorrelations.from_dataset(dataset[list(dict.fromkeys([lv1, lv2]))])
 
-    # Het toevoegen van de correlaties tussen de items van de twee kernvariabelen.
-    for item_1 in items_var1:
-        for item_2 in corr_matrix[item_1].keys():
-            if item_2 in items_var2 and not math.isnan(corr_matrix[item_1][item_2]):
-                heterotrait_list.append(corr_matrix[item_1][item_2])
+    return correlations.correlation_between(lv1, lv2)
 
-            if item_2 in items_var2 and math.isnan(corr_matrix[item_1][item_2]):
-                if not math.isnan(corr_matrix[item_2][item_1]):
-                    heterotrait_list.append(corr_matrix[item_2][item_1])
 
-    # De gemiddelden van de drie lijsten.
-    avg_heterotrait = sum(heterotrait_list) / len(heterotrait_list)
-    avg_monotrait_var1 = sum(monotrait_var1_list) / len(monotrait_var1_list)
-    avg_monotrait_var2 = sum(monotrait_var2_list) / len(monotrait_var2_list)
+def correlation_matrix(dataset, correlations=None):
+    # Alle correlaties worden in één keer berekend (zie "app/analysis.py"). Voor de weergave wordt alleen de onderste
+    # helft van de tabel gegeven, de diagonaal en de bovenste helft zijn leeg (NaN).
+    if correlations is None:
+        correlations = ItemCorrelations.from_dataset(dataset)
 
-    return avg_heterotrait / (math.sqrt(avg_monotrait_var1 * avg_monotrait_var2))
+    return correlations.lower_triangle()
 
 
-def htmt_matrix(dataset, model):
+def corevariable_partition(corevariables, dataset):
+    # Een dictionary met per kernvariabele (afkorting) de bijbehorende items binnen de dataset.
+    partition = {}
+    for corevariable in corevariables:
+        abbreviation = corevariable.abbreviation
+        partition[abbreviation] = [item for item in dataset if item[:len(abbreviation)] == abbreviation]
+
+    return partition
+
+
+def heterotrait_monotrait_matrix(dataset, corevariables, correlations=None):
+    # De volledige tabel met HTMT-ratios, berekend uit één correlatiematrix (zie "htmt_ratios" in "app/analysis.py").
+    if correlations is None:
+        correlations = ItemCorrelations.from_dataset(dataset)
+
+    return htmt_ratios(correlations, corevariable_partition(corevariables, dataset))
+
+
+def heterotrait_monotrait(var1, var2, dataset, correlations=None):
+    ratios = heterotrait_monotrait_matrix(dataset, [var1, var2], correlations)
+
+    return float(ratios[var1.abbreviation][var2.abbreviation])
+
+
+def htmt_matrix(dataset, model, correlations=None):
     corevariables = [corevariable for corevariable in model.linked_corevariables]
+    ratios = heterotrait_monotrait_matrix(dataset, corevariables, correlations)
     # Een dictionary met de HTMT-ratios van de verschillende kernvariabelen.
     data = {}
     for corevariable in corevariables:
         data[corevariable.abbreviation] = []
         not_valuable = False
         for cv2 in corevariables:
-            if round(heterotrait_monotrait(corevariable, cv2, correlation_matrix(dataset), dataset), 4) == 1:
+            value = round(float(ratios[corevariable.abbreviation][cv2.abbreviation]), 4)
+            if value == 1:
                 not_valuable = True
             # Een lege waarde om ervoor te zorgen dat niet de hele tabel, maar slechts de helft gegeven wordt (om ervoor
             # te zorgen dat dezelfde waarden niet twee keer worden gegeven voor betere leesbaarheid, en te voorkomen
@@ -302,8 +646,7 @@ def htmt_matrix(dataset, model):
             if not_valuable:
                 data[corevariable.abbreviation].append(' ')
             else:
-                data[corevariable.abbreviation].append(round(
-                    heterotrait_monotrait(corevariable, cv2, correlation_matrix(dataset), dataset),4))
+                data[corevariable.abbreviation].append(value)
 
     # Het omzetten van de dictionary naar een Pandas Dataframe.
     df = pd.DataFrame(data, index=[corevariable.abbreviation for corevariable in corevariables])
@@ -311,37 +654,35 @@ def htmt_matrix(dataset, model):
     return df
 
 
-def outer_vif_values_dict(dataset, questionnaire):
-    # Een lijst met de code van alle vragen binnen de vragenlijst, verdeeld in sublijsten per kernvariabele
-    # (abbreviations_by_lv).
-    abbreviations_by_lv = []
-    questiongroups = [questiongroup for questiongroup in questionnaire.linked_questiongroups]
-    for questiongroup in questiongroups:
-        questions = [question for question in Question.query.filter_by(questiongroup_id=questiongroup.id)]
-        abbreviations_by_lv.append([question.question_code for question in questions])
-
-    # Een Pandas Dataframe met alle VIF-waarden voor ieder item.
-    dataframes_vif = []
-    for questiongroup in abbreviations_by_lv:
-        X = add_constant(dataset[questiongroup])
-        # VIF dataframe
-        vif_data = pd.DataFrame()
-        vif_data["feature"] = X.columns
-
-        # calculating VIF for each feature
-        vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                           for i in range(len(X.columns))]
-
-        dataframes_vif.append(vif_data)
-
-    result = pd.concat(dataframes_vif)
-    # Het verwijderen van de constantes uit de Pandas Dataserie
-    result_outer_vif = result[result.feature != 'const']
-
-    # Een dictionary met de items en de bijbehorende VIF-waarde (data_outer_vif).
+def structural_model_results(context, model):
+    # Per relatie van het model de padcoëfficiënt, de f² en de (binnenste) VIF-waarde van de beïnvloedende
+    # kernvariabele, allemaal uit de analysecontext.
+    results = []
+    for relation in Relation.query.filter_by(model_id=model.id):
+        influencer = CoreVariable.query.get(relation.influencer_id)
+        influenced = CoreVariable.query.get(relation.influenced_id)
+        results.append({'relation': relation.return_relation(),
+                        'path_coefficient': round(context.path_coefficient(influencer.abbreviation,
+                                                                           influenced.abbreviation), 4),
+                        'f_square': round(context.f_squares[(influencer.abbreviation, influenced.abbreviation)], 4),
+                        'inner_vif': round(float(context.inner_vifs[influenced.abbreviation][influencer.abbreviation]),
+                                           4)})
+    return results
+
+
+def r_squared_results(context, corevariables):
+    # De R² en aangepaste R² van de beïnvloede kernvariabelen.
+    return [{'corevariable': corevariable.name, 'r_squared': round(float(context.r_squared[corevariable.abbreviation]), 4),
+             'r_squared_adj': round(float(context.r_squared_adj[corevariable.abbreviation]), 4)}
+            for corevariable in corevariables if corevariable.abbreviation in context.inner_vifs]
+
+
+def outer_vif_values_dict(context):
+    # Een dictionary met de items en de bijbehorende VIF-waarde (data_outer_vif). De VIF-waarden van alle
+    # kernvariabelen worden in één keer berekend uit de correlatiematrix, zie "outer_vifs" in "app/analysis.py".
     data_outer_vif = {}
-    for i in range(len(result_outer_vif)):
-        data_outer_vif[result_outer_vif.iloc[i]['feature']] = round(float(result_outer_vif.iloc[i]['VIF']), 4)
+    for item, vif in context.outer_vifs.items():
+        data_outer_vif[item] = round(float(vif), 4)
 
     return data_outer_vif
 
@@ -1,24 +1,24 @@
-from flask import render_template, flash, redirect, url_for, request
+import tempfile
+from flask import render_template, flash, redirect, url_for, request, jsonify, current_app, Response, \
+    stream_with_context, send_file, abort
 from flask_login import current_user, login_required
 import numpy as np
 import pandas as pd
-import plspm.config as c
 import json
-from plspm.plspm import Plspm
-from plspm.scheme import Scheme
-from plspm.mode import Mode
 from app import db
 from app.create_study import bp
 from app.create_study.forms import CreateNewStudyForm, EditStudyForm, CreateNewCoreVariableForm, CreateNewRelationForm, \
-    CreateNewDemographicForm, CreateNewQuestionForm, EditQuestionForm, EditScaleForm
-from app.create_study.functions import setup_questiongroups, setup_structure_dataframe, cronbachs_alpha, composite_reliability, \
-    average_variance_extracted, heterotrait_monotrait, htmt_matrix, outer_vif_values_dict, return_questionlist_and_answerlist, \
-    indexes_questiongroups_three, correlation_matrix, check_researchmodel, check_if_used_model
+    CreateNewDemographicForm, CreateNewQuestionForm, EditQuestionForm, EditScaleForm, MultiGroupAnalysisForm
+from app.create_study.functions import setup_questiongroups, heterotrait_monotrait_matrix, htmt_matrix, \
+    outer_vif_values_dict, indexes_questiongroups_three, check_researchmodel, check_if_used_model, \
+    setup_analysis_context, setup_path_significance, structural_model_results, r_squared_results, \
+    setup_group_comparison, question_descriptives, return_result_chunk, stream_template, setup_analysis_report
+from app.export import generate_csv, write_xlsx
+from app.questionnaire.functions import build_questionnaire_snapshot, cache_questionnaire_snapshot, \
+    forget_questionnaire_snapshot
 from app.main.functions import security_and_studycheck_stage1, security_and_studycheck_stage2, security_and_studycheck_stage3
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
 from app.models import User, Study, CoreVariable, Relation, ResearchModel, Questionnaire, QuestionGroup, Question, \
-    Demographic, DemographicOption, Case, DemographicAnswer
+    Demographic, DemographicOption, Case, DemographicAnswer, AnalysisJob, ResponseStatistics
 
 
 #############################################################################################################
@@ -833,7 +833,13 @@ def starting_study(study_code):
     # Omzetting studie van stage_1 (opstellen van het onderzoek) naar stage_2 (het onderzoek is gaande)
     study.stage_1 = False
     study.stage_2 = True
+    # De statistieken van de antwoorden (zie "ResponseStatistics") worden nu al aangemaakt, zodat de eerste voltooide
+    # cases niet tegelijk de rij hoeven aan te maken.
+    if ResponseStatistics.query.filter_by(questionnaire_id=questionnaire.id).first() is None:
+        ResponseStatistics.create(questionnaire)
     db.session.commit()
+    # De vragenlijst ligt vanaf nu vast; de pagina's voor de participanten gebruiken een vastgelegde momentopname.
+    cache_questionnaire_snapshot(build_questionnaire_snapshot(study))
 
     return redirect(url_for('create_study.study_underway', name_study=study.name, study_code=study_code))
 
@@ -868,6 +874,7 @@ def end_study(study_code):
     study.stage_2 = False
     study.stage_3 = True
     db.session.commit()
+    forget_questionnaire_snapshot(study_code)
 
     return redirect(url_for('create_study.summary_results', study_code=study_code))
 
@@ -888,10 +895,66 @@ def summary_results(study_code):
     questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
     demographics = [demographic for demographic in questionnaire.linked_demographics]
     questions = [question for question in questionnaire.linked_questions()]
-    cases = [case for case in questionnaire.linked_cases()]
+    # De demografische antwoorden en de vragenlijstantwoorden per case, in dezelfde volgorde als de kolomkoppen. Alleen
+    # de eerste cases worden direct getoond; de rest wordt per deel opgehaald via "summary_results_rows".
+    demographic_rows, question_rows, next_case_id = return_result_chunk(
+        questionnaire, questions, demographics, limit=current_app.config['RESULTS_PAGE_SIZE'])
 
-    return render_template('create_study/summary_results.html', study_code=study_code, demographics=demographics,
-                           questions=questions, cases=cases, study=study)
+    # Het aantal antwoorden, gemiddelde, standaarddeviatie, minimum, maximum en de frequenties per vraag, berekend met
+    # één query (zie "question_descriptives" binnen "create_study/functions.py").
+    descriptives = question_descriptives(questionnaire)
+    scale_points = range(1, len(next(iter(descriptives.values()))['frequencies']) + 1) if descriptives else []
+
+    return Response(stream_with_context(stream_template(
+        'create_study/summary_results.html', study_code=study_code, demographics=demographics, questions=questions,
+        demographic_rows=demographic_rows, question_rows=question_rows, next_case_id=next_case_id, study=study,
+        descriptives=descriptives, scale_points=scale_points)))
+
+
+@bp.route('/export_results/<study_code>/<file_format>', methods=['GET'])
+@login_required
+def export_results(study_code, file_format):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    # De antwoorden van alle voltooide cases als CSV (gestreamd) of als XLSX (via een tijdelijk bestand, omdat een
+    # XLSX-bestand pas compleet is als het gesloten wordt). Zie "app/export.py".
+    study = Study.query.filter_by(code=study_code).first()
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    filename = 'responses_{}'.format(study.code)
+
+    if file_format == 'csv':
+        return Response(stream_with_context(generate_csv(questionnaire)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename={}.csv'.format(filename)})
+    if file_format == 'xlsx':
+        file = tempfile.TemporaryFile()
+        write_xlsx(questionnaire, file)
+        file.seek(0)
+        return send_file(file, as_attachment=True, download_name='{}.xlsx'.format(filename),
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    abort(404)
+
+
+@bp.route('/summary_results/rows/<study_code>', methods=['GET'])
+@login_required
+def summary_results_rows(study_code):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    # Het volgende deel van de tabellen met resultaten (de cases na "after"), opgevraagd door de pagina met de
+    # samenvatting. Het aantal cases per deel is begrensd, zodat het geheugengebruik per verzoek begrensd blijft.
+    study = Study.query.filter_by(code=study_code).first()
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    demographics = [demographic for demographic in questionnaire.linked_demographics]
+    questions = [question for question in questionnaire.linked_questions()]
+    limit = min(request.args.get('limit', current_app.config['RESULTS_PAGE_SIZE'], type=int),
+                current_app.config['RESULTS_PAGE_SIZE'])
+    demographic_rows, question_rows, next_case_id = return_result_chunk(
+        questionnaire, questions, demographics, after=request.args.get('after', 0, type=int), limit=max(limit, 1))
+
+    return jsonify({'demographic_rows': demographic_rows, 'question_rows': question_rows, 'next': next_case_id})
 
 
 @bp.route('/data_analysis/<study_code>', methods=['GET', 'POST'])
@@ -907,45 +970,39 @@ def data_analysis(study_code):
     model = ResearchModel.query.filter_by(id=study.researchmodel_id).first()
     corevariables = [corevariable for corevariable in model.linked_corevariables]
 
-    # Het opzetten van de dataframe (gebruik van plspm package en pd.dataframe met de vragenlijstresultaten)
     questiongroups = [questiongroup for questiongroup in questionnaire.linked_questiongroups]
-    questionlist_and_answerlist = return_questionlist_and_answerlist(questiongroups)
-    list_of_questions = questionlist_and_answerlist[0]
-    list_of_answers = questionlist_and_answerlist[1]
 
-    df = pd.DataFrame(list_of_answers).transpose()
-    df.columns = list_of_questions
-
-    structure = setup_structure_dataframe(corevariables, model.id)
-
-    config = c.Config(structure.path(), scaled=False)
-    scheme = Scheme.CENTROID
-
-    for corevariable in corevariables:
-        config.add_lv_with_columns_named(corevariable.abbreviation, Mode.A, df, corevariable.abbreviation)
-
-    plspm_calc = Plspm(df, config, scheme)
-    plspm_model = plspm_calc.outer_model()
+    # De analysecontext met de dataframe, de correlatiematrix en het (één keer) geschatte PLS-PM model. Zie
+    # "setup_analysis_context" binnen "create_study/functions.py". Zolang deze op de achtergrond berekend wordt, wordt
+    # de voortgang getoond.
+    context, job = setup_analysis_context(study)
+    if context is None:
+        return render_template('create_study/analysis_progress.html', title='Data-analysis', study=study, job=job)
+    df = context.dataset
 
     # Creëert dictionary met alleen loadings van latente variabele
-    loadings_dct = pd.DataFrame(plspm_model['loading']).to_dict('dict')['loading']
+    loadings_dct = context.loadings.to_dict()
 
     # Een matrix van Heterotrait-Monotrait Ratio wordt hier beschikbaar gemaakt (module "htmt_matrix" staat bovenaan
     # verwezen.
-    data_htmt = htmt_matrix(df, model)
+    data_htmt = htmt_matrix(df, model, context.correlations)
     amount_of_variables = len(corevariables)
 
     # Buitenste VIF-waarden worden hier beschikbaar gemaakt in een dictionary onder "data_outer_vif". Module bovenaan
     # geïmporteerd.
-    outer_vif_dct = outer_vif_values_dict(df, questionnaire)
+    outer_vif_dct = outer_vif_values_dict(context)
+
+    # Het structurele model (padcoëfficiënten, R², f² en de binnenste VIF-waarden) uit dezelfde geschatte analyse.
+    structural_model = structural_model_results(context, model)
+    r_squared = r_squared_results(context, corevariables)
 
     model.edited = False
     db.session.commit()
 
-    return render_template('create_study/data_analysis.html', study_code=study_code, df=df, config=config, scheme=scheme,
+    return render_template('create_study/data_analysis.html', study_code=study_code, df=df, context=context,
                            outer_vif_dct=outer_vif_dct, questiongroups=questiongroups, model=model, corevariables=corevariables,
                            data_htmt=data_htmt, amount_of_variables=amount_of_variables, study=study,
-                           loadings_dct=loadings_dct)
+                           loadings_dct=loadings_dct, structural_model=structural_model, r_squared=r_squared)
 
 
 @bp.route('/data_analysis/corevariable_analysis/<study_code>/<questiongroup_id>', methods=['GET', 'POST'])
@@ -966,31 +1023,17 @@ def corevariable_analysis(study_code, questiongroup_id):
     questions_of_questiongroup = [question for question in relevant_questiongroup.linked_questions()]
     length_questionlist = len(questions_of_questiongroup)
 
-    # Het opzetten van de dataframe (gebruik van plspm package en pd.dataframe met de vragenlijstresultaten)
-    questionlist_and_answerlist = return_questionlist_and_answerlist(questiongroups)
-    list_of_questions = questionlist_and_answerlist[0]
-    list_of_answers = questionlist_and_answerlist[1]
-
-    df = pd.DataFrame(list_of_answers).transpose()
-    df.columns = list_of_questions
-
-    # Functie "setup_structure_dataframe" terug te vinden in "new_study/functions".
-    structure = setup_structure_dataframe(corevariables, model.id)
-
-    config = c.Config(structure.path(), scaled=False)
-    scheme = Scheme.CENTROID
-
-    for corevariable in corevariables:
-        config.add_lv_with_columns_named(corevariable.abbreviation, Mode.A, df, corevariable.abbreviation)
-
-    plspm_calc = Plspm(df, config, Scheme.CENTROID)
-    model1 = plspm_calc.outer_model()
+    # De analysecontext met de dataframe en het (één keer) geschatte PLS-PM model.
+    context, job = setup_analysis_context(study)
+    if context is None:
+        return render_template('create_study/analysis_progress.html', title='Data-analysis', study=study, job=job)
+    df = context.dataset
 
     # De AVE, Cronbach's Alpha, Composite Reliability voor de fullscreen grafieken (met alle kernvariabelen erin).
     corevariable_js_all = [corevariable for corevariable in model.linked_corevariables]
-    corevariable_ave_js_all = [questiongroup.return_ave(model, df, config, scheme) for questiongroup in questiongroups]
-    corevariable_ca_js_all = [questiongroup.return_cronbachs_alpha(model, df) for questiongroup in questiongroups]
-    corevariable_cr_js_all = [questiongroup.return_composite_reliability(model, df, config, scheme)
+    corevariable_ave_js_all = [questiongroup.return_ave(model, context) for questiongroup in questiongroups]
+    corevariable_ca_js_all = [questiongroup.return_cronbachs_alpha(model, context) for questiongroup in questiongroups]
+    corevariable_cr_js_all = [questiongroup.return_composite_reliability(model, context)
                               for questiongroup in questiongroups]
 
     # De AVE, Cronbach's Alpha, Composite Reliability, ladingen, VIF-waarden en HTMT-ratios voor de kleinere grafieken
@@ -1006,36 +1049,37 @@ def corevariable_analysis(study_code, questiongroup_id):
                              [corevariables[indexes_questiongroups[0]], corevariables[indexes_questiongroups[1]],
                               corevariables[indexes_questiongroups[2]]]]
     # AVE-lijst
-    corevariable_ave_js = [questiongroup.return_ave(model, df, config, scheme) for
+    corevariable_ave_js = [questiongroup.return_ave(model, context) for
                            questiongroup in questiongroups[indexes_questiongroups[0]:indexes_questiongroups[2] + 1]]
     # Cronbach's Alpha lijst
-    corevariable_ca_js = [questiongroup.return_cronbachs_alpha(model, df) for
+    corevariable_ca_js = [questiongroup.return_cronbachs_alpha(model, context) for
                           questiongroup in questiongroups[indexes_questiongroups[0]:indexes_questiongroups[2] + 1]]
     # Composite Reliability lijst
-    corevariable_cr_js = [questiongroup.return_composite_reliability(model, df, config, scheme) for
+    corevariable_cr_js = [questiongroup.return_composite_reliability(model, context) for
                           questiongroup in questiongroups[indexes_questiongroups[0]:indexes_questiongroups[2] + 1]]
 
     length_corevariables = len(corevariable_js_all)
 
     # VIF-waarden
-    dct_of_all_vifs = outer_vif_values_dict(df, questionnaire)
+    dct_of_all_vifs = outer_vif_values_dict(context)
     corevariable_abbreviation = relevant_questiongroup.return_corevariable_abbreviation()
     corevariable_vif_js = [dct_of_all_vifs[key] for key in dct_of_all_vifs if key[:len(corevariable_abbreviation)] ==
                            corevariable_abbreviation]
 
-    # HTMT-waarden
+    # HTMT-waarden (alle ratios worden in één keer berekend uit één correlatiematrix).
+    htmt_ratios = heterotrait_monotrait_matrix(df, corevariables, context.correlations)
     corevariable = CoreVariable.query.filter_by(id=relevant_questiongroup.corevariable_id).first()
     corevariables_htmt = corevariables
     corevariables_htmt.remove(corevariable)
     length_corevariables_htmt = len(corevariables_htmt)
     corevariable_names_htmt_js = corevariables_htmt[:3]
-    corevariable_htmt_js = [round(heterotrait_monotrait(corevariable, lv, correlation_matrix(df), df), 4)
+    corevariable_htmt_js = [round(float(htmt_ratios[corevariable.abbreviation][lv.abbreviation]), 4)
                             for lv in corevariables_htmt[:3]]
-    corevariable_htmt_js_all = [round(heterotrait_monotrait(corevariable, lv, correlation_matrix(df), df), 4)
+    corevariable_htmt_js_all = [round(float(htmt_ratios[corevariable.abbreviation][lv.abbreviation]), 4)
                                 for lv in corevariables_htmt]
 
     # Ladingen van de items
-    loadings_dct = pd.DataFrame(model1['loading']).to_dict('dict')['loading']
+    loadings_dct = context.loadings.to_dict()
     loadings_list = [question.return_loading(loadings_dct) for question in questions_of_questiongroup]
 
     return render_template('create_study/corevariable_analysis.html', study_code=study_code, corevariable=corevariable,
@@ -1048,3 +1092,119 @@ def corevariable_analysis(study_code, questiongroup_id):
                            loadings_list=loadings_list, corevariables_htmt=corevariables_htmt,
                            corevariable_htmt_js=corevariable_htmt_js, corevariable_names_htmt_js=corevariable_names_htmt_js,
                            length_corevariables_htmt=length_corevariables_htmt, corevariable_htmt_js_all=corevariable_htmt_js_all)
+
+
+@bp.route('/data_analysis/report/<study_code>/<file_format>', methods=['GET'])
+@login_required
+def analysis_report(study_code, file_format):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+    if file_format not in ('xlsx', 'json'):
+        abort(404)
+
+    study = Study.query.filter_by(code=study_code).first()
+
+    # Het rapport met alle uitkomsten van de analyse (zie "setup_analysis_report" binnen "create_study/functions.py").
+    # Zolang het op de achtergrond geschreven wordt, wordt de voortgang getoond; daarna wordt het bewaarde bestand
+    # gedownload zolang de data en het model niet veranderen.
+    path, job = setup_analysis_report(study, file_format)
+    if path is None:
+        return render_template('create_study/analysis_progress.html', title='Data-analysis', study=study, job=job)
+
+    mimetypes = {'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                 'json': 'application/json'}
+    return send_file(path, as_attachment=True, download_name='analysis_report_{}.{}'.format(study.code, file_format),
+                     mimetype=mimetypes[file_format])
+
+
+@bp.route('/data_analysis/path_significance/<study_code>', methods=['GET'])
+@login_required
+def path_significance(study_code):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    study = Study.query.filter_by(code=study_code).first()
+
+    # De significantie van de padcoëfficiënten per relatie. Zolang de bootstrap op de achtergrond berekend wordt, worden
+    # de voortgang en de tussentijdse resultaten getoond.
+    significances, job = setup_path_significance(study)
+
+    return render_template('create_study/path_significance.html', title='Path significance', study=study,
+                           significances=significances, job=job)
+
+
+@bp.route('/data_analysis/multigroup_analysis/<study_code>', methods=['GET', 'POST'])
+@login_required
+def multigroup_analysis(study_code):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    study = Study.query.filter_by(code=study_code).first()
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+
+    # Alleen demografische vragen met antwoordopties kunnen de cases in groepen verdelen.
+    form = MultiGroupAnalysisForm()
+    form.demographic.choices = [(demographic.id, demographic.name) for demographic in
+                                questionnaire.linked_demographics if demographic.questiontype != "open"]
+
+    if form.validate_on_submit():
+        return redirect(url_for('create_study.multigroup_analysis', study_code=study_code,
+                                demographic_id=form.demographic.data))
+
+    # De vergelijking van de groepen van de gekozen demografische vraag. Zolang deze op de achtergrond berekend wordt,
+    # wordt de voortgang getoond.
+    results, job = None, None
+    demographic_id = request.args.get('demographic_id', type=int)
+    if demographic_id in [choice[0] for choice in form.demographic.choices]:
+        form.demographic.data = demographic_id
+        results, job = setup_group_comparison(study, Demographic.query.get(demographic_id), 'multigroup')
+
+    return render_template('create_study/multigroup_analysis.html', title='Multi-group analysis', study=study,
+                           form=form, results=results, job=job)
+
+
+@bp.route('/data_analysis/measurement_invariance/<study_code>', methods=['GET', 'POST'])
+@login_required
+def measurement_invariance(study_code):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    study = Study.query.filter_by(code=study_code).first()
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+
+    form = MultiGroupAnalysisForm()
+    form.demographic.choices = [(demographic.id, demographic.name) for demographic in
+                                questionnaire.linked_demographics if demographic.questiontype != "open"]
+
+    if form.validate_on_submit():
+        return redirect(url_for('create_study.measurement_invariance', study_code=study_code,
+                                demographic_id=form.demographic.data))
+
+    # De meetinvariantie (MICOM) tussen de groepen van de gekozen demografische vraag.
+    results, job = None, None
+    demographic_id = request.args.get('demographic_id', type=int)
+    if demographic_id in [choice[0] for choice in form.demographic.choices]:
+        form.demographic.data = demographic_id
+        results, job = setup_group_comparison(study, Demographic.query.get(demographic_id), 'invariance')
+
+    return render_template('create_study/measurement_invariance.html', title='Measurement invariance', study=study,
+                           form=form, results=results, job=job)
+
+
+@bp.route('/analysis_job/<study_code>/<job_id>', methods=['GET'])
+@login_required
+def analysis_job(study_code, job_id):
+    security_check = security_and_studycheck_stage3(study_code)
+    if security_check is not None:
+        return security_check
+
+    # De status en voortgang van een achtergrondberekening, opgevraagd door de voortgangspagina.
+    study = Study.query.filter_by(code=study_code).first()
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    job = AnalysisJob.query.filter_by(id=job_id, questionnaire_id=questionnaire.id).first_or_404()
+
+    return jsonify(job.as_dict())
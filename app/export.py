@@ -0,0 +1,100 @@
+import csv
+import io
+import json
+import os
+from itertools import groupby
+import pandas as pd
+import xlsxwriter
+from app import db
+from app.models import Case, DemographicAnswer, QuestionAnswer, QuestionGroup, Question
+
+
+# Het exporteren van de antwoorden van een vragenlijst (per voltooide case de demografische antwoorden en de scores
+# van de items) als CSV of XLSX, bijvoorbeeld voor SPSS of R. De antwoorden worden met een server-side cursor in delen
+# gelezen en direct weggeschreven, zodat ook bij heel veel cases nooit de volledige dataset in het geheugen staat.
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_header(questionnaire):
+    # De kolommen van de export: het ID van de case, de demografische vragen en de vragen (items) van de vragenlijst.
+    demographics = [demographic for demographic in questionnaire.linked_demographics]
+    questions = db.session.query(Question.id, Question.question_code).join(
+        QuestionGroup, Question.questiongroup_id == QuestionGroup.id).filter(
+        QuestionGroup.questionnaire_id == questionnaire.id).order_by(QuestionGroup.id, Question.id).all()
+
+    columns = [('demographic', demographic.id) for demographic in demographics] + \
+              [('question', question_id) for (question_id, _) in questions]
+    header = ['ID'] + [demographic.name for demographic in demographics] + \
+             [question_code for (_, question_code) in questions]
+    return header, columns
+
+
+def export_rows(questionnaire, columns, batch_size=EXPORT_BATCH_SIZE):
+    # Eén rij per voltooide case, in de volgorde van de kolommen. Beide soorten antwoorden worden met één query (UNION
+    # ALL, gesorteerd op case) gelezen, zodat er maar één cursor tegelijk open is.
+    completed = db.and_(Case.questionnaire_id == questionnaire.id, Case.completed.is_(True))
+    demographic_answers = db.select(
+        DemographicAnswer.case_id.label('case_id'), db.literal('demographic').label('kind'),
+        DemographicAnswer.demographic_id.label('column_id'), DemographicAnswer.answer.label('answer'),
+        db.null().label('score')).join(Case, DemographicAnswer.case_id == Case.id).where(completed)
+    question_answers = db.select(
+        QuestionAnswer.case_id.label('case_id'), db.literal('question').label('kind'),
+        QuestionAnswer.question_id.label('column_id'), db.null().label('answer'),
+        QuestionAnswer.score.label('score')).join(Case, QuestionAnswer.case_id == Case.id).where(completed)
+    statement = db.union_all(demographic_answers, question_answers).order_by('case_id')
+
+    positions = {column: position for position, column in enumerate(columns)}
+    result = db.session.execute(statement, execution_options={'stream_results': True}).yield_per(batch_size)
+    for case_id, answers in groupby(result, key=lambda answer: answer.case_id):
+        row = [None] * len(columns)
+        for answer in answers:
+            position = positions.get((answer.kind, answer.column_id))
+            if position is not None:
+                row[position] = answer.score if answer.kind == 'question' else answer.answer
+        yield [case_id] + row
+
+
+def generate_csv(questionnaire):
+    # De CSV-export als generator van tekst, geschikt voor een gestreamde response.
+    header, columns = export_header(questionnaire)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(header)
+    for number, row in enumerate(export_rows(questionnaire, columns), 1):
+        writer.writerow(row)
+        if number % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def write_xlsx(questionnaire, file):
+    # De XLSX-export naar een bestand (pad of bestandsobject). In "constant_memory" modus schrijft XlsxWriter iedere rij
+    # direct weg, zodat het geheugengebruik niet groeit met het aantal cases.
+    header, columns = export_header(questionnaire)
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Responses')
+    bold = workbook.add_format({'bold': True})
+
+    worksheet.write_row(0, 0, header, bold)
+    for number, row in enumerate(export_rows(questionnaire, columns), 1):
+        worksheet.write_row(number, 0, row)
+    workbook.close()
+
+
+def write_report(frames, path, file_format):
+    # Een rapport met alle tabellen van de analyse (zie "AnalysisContext.report"): als XLSX met één werkblad per tabel,
+    # of als JSON met één object per tabel. Het bestand wordt eerst onder een tijdelijke naam geschreven, zodat een
+    # half geschreven rapport nooit gedownload wordt.
+    temporary = os.path.join(os.path.dirname(path), '.{}_{}'.format(os.getpid(), os.path.basename(path)))
+    if file_format == 'xlsx':
+        with pd.ExcelWriter(temporary, engine='xlsxwriter') as writer:
+            for name, frame in frames.items():
+                frame.to_excel(writer, sheet_name=name[:31])
+    else:
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({name: json.loads(frame.to_json(orient='split')) for name, frame in frames.items()}, file)
+    os.replace(temporary, path)
@@ -0,0 +1,156 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import AnalysisJob
+
+
+# Het uitvoeren van zware berekeningen op de achtergrond. De berekeningen worden in een aparte pool van processen
+# uitgevoerd, zodat de webworkers niet geblokkeerd worden. De status en het resultaat worden opgeslagen in de database
+# (zie "AnalysisJob" in "models.py"), waardoor iedere webworker het resultaat kan ophalen.
+
+_executor = None
+_executor_lock = Lock()
+# De applicatie binnen een procesworker, aangemaakt met dezelfde configuratie als de webapplicatie.
+_worker_app = None
+
+
+def _setup_worker(settings):
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app(type('WorkerConfig', (object,), settings))
+
+
+def executor(app):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            settings = {key: value for key, value in app.config.items() if key.isupper()}
+            _executor = ProcessPoolExecutor(max_workers=app.config['ANALYSIS_WORKERS'], initializer=_setup_worker,
+                                            initargs=(settings,))
+    return _executor
+
+
+def run_job(job_id, function, *args):
+    # Binnen een procesworker: de applicatiecontext van de worker gebruiken.
+    if _worker_app is not None:
+        with _worker_app.app_context():
+            return _run_job(job_id, function, *args)
+    return _run_job(job_id, function, *args)
+
+
+def _run_job(job_id, function, *args):
+    job = AnalysisJob.query.get(job_id)
+    job.status = 'running'
+    db.session.commit()
+
+    try:
+        # De functie krijgt de job mee, zodat deze de voortgang kan bijwerken met "job.update_progress".
+        result = function(job, *args)
+        job.set_result(result)
+        job.status = 'finished'
+        job.progress = 1
+    except Exception as error:
+        # De volledige foutmelding komt alleen in het log van de server; de job (en daarmee de pagina) krijgt een korte
+        # melding.
+        current_app.logger.exception('Analysis job %s (%s) failed', job_id, function.__name__)
+        db.session.rollback()
+        job = AnalysisJob.query.get(job_id)
+        job.status = 'failed'
+        job.error = 'The calculation failed ({}). The details have been logged on the server.'.format(
+            type(error).__name__)
+    job.finished = datetime.utcnow()
+    db.session.commit()
+
+
+def enqueue_job(kind, key, questionnaire_id, function, *args):
+    # Per soort en sleutel is er maar één job. Een bestaande job wordt hergebruikt, tenzij deze mislukt is of al te lang
+    # loopt (bijvoorbeeld omdat het proces gestopt is); dan wordt dezelfde job opnieuw gestart. Als twee verzoeken
+    # tegelijk dezelfde job aanmaken of opnieuw starten, voert maar één van beide de berekening uit.
+    job = AnalysisJob.query.filter_by(kind=kind, key=key).first()
+    if job is None:
+        job = AnalysisJob(kind=kind, key=key, questionnaire_id=questionnaire_id, message='Waiting for a worker')
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return AnalysisJob.query.filter_by(kind=kind, key=key).first()
+        prune_jobs(kind, questionnaire_id)
+    else:
+        timeout = timedelta(seconds=current_app.config['ANALYSIS_JOB_TIMEOUT'])
+        if job.is_finished() or (not job.is_failed() and datetime.utcnow() - job.created < timeout):
+            return job
+        # Alleen opnieuw starten als de job sinds het lezen niet door een ander verzoek opnieuw gestart is.
+        restarted = db.session.execute(
+            db.update(AnalysisJob).where(AnalysisJob.id == job.id, AnalysisJob.status == job.status,
+                                         AnalysisJob.created == job.created)
+            .values(status='queued', progress=0, message='Waiting for a worker', result=None, partial=None,
+                    error=None, created=datetime.utcnow(), finished=None)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        if restarted.rowcount == 0:
+            return job
+
+    # Zonder procesworkers (ANALYSIS_WORKERS = 0) wordt de job direct binnen het verzoek uitgevoerd.
+    if current_app.config['ANALYSIS_WORKERS'] == 0:
+        run_job(job.id, function, *args)
+        db.session.refresh(job)
+    else:
+        executor(current_app._get_current_object()).submit(run_job, job.id, function, *args)
+
+    return job
+
+
+def prune_jobs(kind, questionnaire_id):
+    # Iedere nieuwe versie van de data of het model geeft een nieuwe sleutel en dus een nieuwe job met een (groot)
+    # resultaat. Per vragenlijst en soort worden alleen de ANALYSIS_JOB_HISTORY nieuwste afgeronde jobs bewaard; oudere
+    # (vervangen) jobs worden verwijderd. Jobs die nog wachten of lopen blijven altijd staan.
+    old_jobs = db.session.query(AnalysisJob.id).filter(
+        AnalysisJob.kind == kind, AnalysisJob.questionnaire_id == questionnaire_id,
+        AnalysisJob.status.in_(['finished', 'failed'])).order_by(AnalysisJob.id.desc()).offset(
+        current_app.config['ANALYSIS_JOB_HISTORY']).all()
+    if len(old_jobs) > 0:
+        AnalysisJob.query.filter(AnalysisJob.id.in_([job_id for (job_id,) in old_jobs])).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+
+# De gedeelde data (zoals de volledige responsmatrix) binnen de procesworkers van "run_batches".
+_shared = None
+
+
+def _share(shared):
+    global _shared
+    _shared = shared
+
+
+def _run_batch(function, *arguments):
+    if _shared is None:
+        return function(*arguments)
+    return function(_shared, *arguments)
+
+
+def run_batches(function, batches, callback, shared=None):
+    # Binnen een job: een berekening die uit meerdere onafhankelijke batches bestaat (zoals bootstrap-steekproeven)
+    # over een eigen pool van processen verdelen. "batches" is een lijst met de argumenten per batch; "callback" krijgt
+    # het nummer en het resultaat van iedere batch zodra deze klaar is, zodat de job tussentijdse resultaten kan tonen.
+    # De functie mag daarom geen gebruik maken van de database of de applicatie.
+    # Als "shared" gegeven is, krijgt de functie deze als eerste argument. De procesworkers krijgen deze één keer bij
+    # het opstarten mee (bij "fork" zonder kopie), zodat een batch alleen aan hoeft te geven welk deel (bijvoorbeeld
+    # welke rijen) het nodig heeft.
+    # Een daemonproces mag geen eigen processen starten. Tot Python 3.9 zijn de procesworkers van "executor" dat wel;
+    # de batches worden daar dan binnen het proces van de job zelf uitgevoerd.
+    workers = current_app.config['ANALYSIS_WORKERS']
+    if workers == 0 or multiprocessing.current_process().daemon:
+        for index, arguments in enumerate(batches):
+            callback(index, function(*arguments) if shared is None else function(shared, *arguments))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_share, initargs=(shared,)) as pool:
+        futures = {pool.submit(_run_batch, function, *arguments): index for index, arguments in enumerate(batches)}
+        for future in as_completed(futures):
+            callback(futures[future], future.result())
@@ -1,4 +1,6 @@
 from hashlib import md5
+import json
+import pickle
 import uuid
 from datetime import datetime
 from hashlib import md5
@@ -6,16 +8,15 @@ from time import time
 import jwt
 from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from wtforms import StringField, SelectField, RadioField, SelectMultipleField
 from wtforms.validators import DataRequired
 from app import db, login
+from app.analysis import ItemCorrelations
 import numpy as np
 
 import plspm.config as c
-from plspm.plspm import Plspm
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
 import math
 import pandas as pd
 
@@ -208,6 +209,13 @@ class Questionnaire(db.Model):
         cases = [case for case in Case.query.filter_by(questionnaire_id=self.id, completed=True)]
         return cases
 
+    def data_version(self):
+        # De versie van de data, bepaald door het aantal voltooide cases en het hoogste ID daarvan. Zodra een case
+        # voltooid wordt verandert de versie, waardoor eerder berekende analyses niet meer gebruikt worden.
+        total, last_case_id = db.session.query(db.func.count(Case.id), db.func.max(Case.id)).filter(
+            Case.questionnaire_id == self.id, Case.completed.is_(True)).one()
+        return '{}-{}'.format(total, last_case_id)
+
     def linked_questions(self):
         questions = []
         for questiongroup in self.linked_questiongroups:
@@ -247,135 +255,70 @@ class QuestionGroup(db.Model):
 
     # Berekeningen
 
-    def generate_ave(self, dataset, configuration, scheme):
-        corevariable = CoreVariable.query.filter_by(id=self.corevariable_id).first()
-
-        abbreviation = corevariable.abbreviation
-        plspm_calc = Plspm(dataset, configuration, scheme)
-        model = plspm_calc.outer_model()
-
-        # Dictionary met alleen loadings van latente variabele (loadings_dct)
-        loadings_dct = pd.DataFrame(model['loading']).to_dict('dict')['loading']
-        not_questions = [question for question in loadings_dct if question[:len(abbreviation)] == abbreviation]
-        loadings_dct = {key: loadings_dct[key] for key in loadings_dct if key in not_questions}
+    def generate_ave(self, context):
+        # De AVE wordt opgezocht in de analysecontext, waarbinnen het PLS-PM model al één keer geschat is.
+        abbreviation = self.return_corevariable_abbreviation()
 
-        # Lijst met ladingen (loadings), lijst met gekwadrateerde ladingen (loadings_squared) en de populatie (oftewel
-        # hoeveel ladingen/items er zijn.
-        loadings = [loadings_dct[i] for i in loadings_dct]
-        loadings_squared = [score * score for score in loadings]
-        population = len(loadings)
+        return context.average_variance_extracted(abbreviation)
 
-        return sum(loadings_squared) / population
-
-    def return_ave(self, model, dataset, configuration, scheme):
+    def return_ave(self, model, context):
         if not model.edited:
             ave = AverageVarianceExtracted.query.filter_by(questiongroup_id=self.id).first()
             if not ave:
-                ave = AverageVarianceExtracted(value=self.generate_ave(dataset, configuration, scheme),
-                                               questiongroup_id=self.id)
+                ave = AverageVarianceExtracted(value=self.generate_ave(context), questiongroup_id=self.id)
                 db.session.add(ave)
                 db.session.commit()
             return round(ave.value, 4)
         else:
-            ave = AverageVarianceExtracted(value=self.generate_ave(dataset, configuration, scheme),
-                                           questiongroup_id=self.id)
+            ave = AverageVarianceExtracted(value=self.generate_ave(context), questiongroup_id=self.id)
             db.session.add(ave)
             db.session.commit()
 
             return round(ave.value, 4)
 
     def variance(self, items, dataset):
-        # Als er één item is gegeven binnen de lijst (de variantie van één item wordt berekend).
-        if len(items) == 1:
-            # De item wordt gereturned met "item"
-            item = items[0]
-            scores = [score for score in dataset[item]]
-            average = sum(scores) / len(scores)
-            # Een lijst met de gekwadrateerde verschillen tussen de scores en de gemiddelde van de scores
-            differences_squared = [(score - average) * (score - average) for score in scores]
-
-            return sum(differences_squared) / (len(scores))
-
-        # Als er meerdere items gegeven zijn.
-        else:
-            scores_per_case = {}
-            scores = len([score for score in dataset[items[0]]])
-            for question in items:
-                for row in range(scores):
-                    if row in scores_per_case:
-                        scores_per_case[row].append(dataset[question][row])
-                    else:
-                        scores_per_case[row] = []
-                        scores_per_case[row].append(dataset[question][row])
-
-            list_of_totals = [sum(scores_per_case[case]) for case in scores_per_case]
+        # De variantie van één item, of bij meerdere items de variantie van de "totaal"kolom (per case de scores
+        # opgeteld). Zie "ItemCorrelations" in "app/analysis.py".
+        return ItemCorrelations.from_dataset(dataset[items]).variance(items)
 
-            average = sum(list_of_totals) / len(list_of_totals)
-            differences_squared = [(score - average) * (score - average) for score in list_of_totals]
+    def generate_cronbachs_alpha(self, context):
+        # Cronbach's Alpha wordt voor alle kernvariabelen tegelijk berekend binnen de analysecontext en hier opgezocht.
+        abbreviation = self.return_corevariable_abbreviation()
 
-            return sum(differences_squared) / (len(list_of_totals))
+        return context.cronbachs_alpha(abbreviation)
 
-    def generate_cronbachs_alpha(self, dataset):
-        corevariable = CoreVariable.query.filter_by(id=self.corevariable_id).first()
-
-        abbreviation = corevariable.abbreviation
-        # Alle vragen binnen de kernvariabele.
-        questions = [i for i in [question for question in dataset if question[:len(abbreviation)] == abbreviation]]
-        total_items = len(questions)
-        # De variantie van de "totaal"kolom, oftewel per case de scores opgeteld.
-        variance_total_column = self.variance(questions, dataset)
-        # Een lijst met de varianties voor iedere item
-        variance_questions = [self.variance([question], dataset) for question in questions]
-
-        return (total_items / (total_items - 1)) * (
-                (variance_total_column - sum(variance_questions)) / variance_total_column)
-
-    def return_cronbachs_alpha(self, model, dataset):
+    def return_cronbachs_alpha(self, model, context):
         if not model.edited:
             ca = CronbachsAlpha.query.filter_by(questiongroup_id=self.id).first()
             if not ca:
-                ca = CronbachsAlpha(value=self.generate_cronbachs_alpha(dataset), questiongroup_id=self.id)
+                ca = CronbachsAlpha(value=self.generate_cronbachs_alpha(context), questiongroup_id=self.id)
                 db.session.add(ca)
                 db.session.commit()
             return round(ca.value, 4)
         else:
-            ca = CronbachsAlpha(value=self.generate_cronbachs_alpha(dataset), questiongroup_id=self.id)
+            ca = CronbachsAlpha(value=self.generate_cronbachs_alpha(context), questiongroup_id=self.id)
             db.session.add(ca)
             db.session.commit()
 
             return round(ca.value, 4)
 
-    def generate_composite_reliability(self, dataset, configuration, scheme):
-        corevariable = CoreVariable.query.filter_by(id=self.corevariable_id).first()
-
-        abbreviation = corevariable.abbreviation
-        plspm_calc = Plspm(dataset, configuration, scheme)
-        model = plspm_calc.outer_model()
+    def generate_composite_reliability(self, context):
+        # De Composite Reliability wordt opgezocht in de analysecontext (zie "generate_ave").
+        abbreviation = self.return_corevariable_abbreviation()
 
-        # Dictionary met alleen loadings van kernvariabele (loadings_dct)
-        loadings_dct = pd.DataFrame(model['loading']).to_dict('dict')['loading']
-        questions = [question for question in loadings_dct if question[:len(abbreviation)] == abbreviation]
-        loadings_dct = {key: loadings_dct[key] for key in loadings_dct if key in questions}
+        return context.composite_reliability(abbreviation)
 
-        # Lijst met de ladingen (loadings), lijst met de gekwadrateerde ladingen (loadings_squared) en lijst met de
-        # errors (errors).
-        loadings = [loadings_dct[i] for i in loadings_dct]
-        loadings_squared = [score * score for score in loadings]
-        errors = [1 - score for score in loadings_squared]
-
-        return (sum(loadings) * sum(loadings)) / ((sum(loadings) * sum(loadings)) + sum(errors))
-
-    def return_composite_reliability(self, model, dataset, configuration, scheme):
+    def return_composite_reliability(self, model, context):
         if not model.edited:
             cr = CompositeReliability.query.filter_by(questiongroup_id=self.id).first()
             if not cr:
-                cr = CompositeReliability(value=self.generate_composite_reliability(dataset, configuration, scheme),
+                cr = CompositeReliability(value=self.generate_composite_reliability(context),
                                           questiongroup_id=self.id)
                 db.session.add(cr)
                 db.session.commit()
             return round(cr.value, 4)
         else:
-            cr = CompositeReliability(value=self.generate_composite_reliability(dataset, configuration, scheme),
+            cr = CompositeReliability(value=self.generate_composite_reliability(context),
                                       questiongroup_id=self.id)
             db.session.add(cr)
             db.session.commit()
@@ -390,6 +333,25 @@ class QuestionType(db.Model):
         return '<Question type {}>'.format(self.name)
 
 
+def demographic_field(name, questiontype, optional, options):
+    # Het veld om een demografiek in te vullen, afhankelijk van het soort vraag. Verplichte velden krijgen een "*".
+    if questiontype == "open":
+        if optional:
+            return StringField(name)
+        required_name = name + '*'
+        return StringField(required_name, validators=[DataRequired()])
+    elif questiontype == "multiplechoice":
+        if optional:
+            return SelectMultipleField(u'{}'.format(name), choices=list(options))
+        required_name = name + '*'
+        return SelectMultipleField(u'{}'.format(required_name), choices=list(options))
+    elif questiontype == "radio":
+        if optional:
+            return RadioField(u'{}'.format(name), choices=list(options))
+        required_name = name + '*'
+        return RadioField(u'{}'.format(required_name), choices=list(options))
+
+
 class Demographic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50))
@@ -413,23 +375,7 @@ class Demographic(db.Model):
         return options
 
     def return_field(self):
-        if self.questiontype == "open":
-            if self.optional:
-                return StringField(self.name)
-            required_name = self.name + '*'
-            return StringField(required_name, validators=[DataRequired()])
-        elif self.questiontype == "multiplechoice":
-            if self.optional:
-                choices = self.return_list_of_options()
-                return SelectMultipleField(u'{}'.format(self.name), choices=choices)
-            required_name = self.name + '*'
-            return SelectMultipleField(u'{}'.format(required_name), choices=self.return_list_of_options())
-        elif self.questiontype == "radio":
-            if self.optional:
-                choices = self.return_list_of_options()
-                return RadioField(u'{}'.format(self.name), choices=choices)
-            required_name = self.name + '*'
-            return RadioField(u'{}'.format(required_name), choices=self.return_list_of_options())
+        return demographic_field(self.name, self.questiontype, self.optional, self.return_list_of_options())
 
     def return_amount_of_options(self):
         return len(self.return_list_of_options())
@@ -549,3 +495,176 @@ class CompositeReliability(db.Model):
     value = db.Column(db.Float)
 
     questiongroup_id = db.Column(db.Integer, db.ForeignKey('question_group.id'))
+
+
+class ResponseStatistics(db.Model):
+    # Per vragenlijst het aantal voltooide cases (n), de som van de scores per vraag en de kruisproducten van de scores
+    # tussen alle vragen. Deze worden bijgewerkt zodra een case voltooid wordt, waardoor gemiddelden, varianties,
+    # covarianties en correlaties berekend kunnen worden zonder alle antwoorden opnieuw te lezen.
+    id = db.Column(db.Integer, primary_key=True)
+    n = db.Column(db.Integer, default=0)
+    questions = db.Column(db.Text)
+    sums = db.Column(db.LargeBinary(length=2 ** 24))
+    crossproducts = db.Column(db.LargeBinary(length=2 ** 24))
+
+    questionnaire_id = db.Column(db.Integer, db.ForeignKey('questionnaire.id'), unique=True)
+
+    def __repr__(self):
+        return '<Response statistics {} ({} cases)>'.format(self.questionnaire_id, self.n)
+
+    @staticmethod
+    def for_questionnaire(questionnaire):
+        # De rij wordt vergrendeld (SELECT ... FOR UPDATE) zodat gelijktijdig voltooide cases elkaar niet overschrijven.
+        # De rij wordt normaal al bij het starten van het onderzoek aangemaakt (zie "create"); als de eerste rij toch
+        # gelijktijdig aangemaakt wordt, wordt alleen die poging teruggedraaid en de rij van de ander gebruikt.
+        query = ResponseStatistics.query.filter_by(questionnaire_id=questionnaire.id).with_for_update()
+        statistics = query.first()
+        if statistics is None:
+            try:
+                with db.session.begin_nested():
+                    statistics = ResponseStatistics.create(questionnaire)
+            except IntegrityError:
+                statistics = query.first()
+        return statistics
+
+    @staticmethod
+    def create(questionnaire):
+        # De vragen staan in dezelfde volgorde als in de dataset van de analyse (per vragenlijstgroep, daarbinnen per
+        # vraag).
+        question_ids = db.session.query(Question.id).join(QuestionGroup, Question.questiongroup_id == QuestionGroup.id)\
+            .filter(QuestionGroup.questionnaire_id == questionnaire.id).order_by(QuestionGroup.id, Question.id)
+        statistics = ResponseStatistics(questionnaire_id=questionnaire.id)
+        statistics.reset([question_id for (question_id,) in question_ids])
+        db.session.add(statistics)
+        return statistics
+
+    def question_ids(self):
+        return [int(question_id) for question_id in self.questions.split(',') if question_id]
+
+    def reset(self, question_ids):
+        self.n = 0
+        self.questions = ','.join(str(question_id) for question_id in question_ids)
+        self.sums = np.zeros(len(question_ids), dtype=np.int64).tobytes()
+        self.crossproducts = np.zeros((len(question_ids), len(question_ids)), dtype=np.int64).tobytes()
+
+    def rebuild(self, question_ids, scores):
+        # Het opnieuw opbouwen vanuit de volledige matrix met scores (cases x vragen).
+        scores = np.asarray(scores, dtype=np.int64)
+        self.reset(question_ids)
+        self.n = scores.shape[0]
+        self.sums = scores.sum(axis=0).tobytes()
+        self.crossproducts = (scores.T @ scores).tobytes()
+
+    def add_case(self, answers):
+        # "answers" is een dictionary met de vraag-ID als key en de score als waarde.
+        question_ids = self.question_ids()
+        # Als niet alle vragen beantwoord zijn worden de statistieken niet bijgewerkt; bij de analyse wordt dan gezien
+        # dat het aantal cases niet klopt en worden ze opnieuw opgebouwd. Hetzelfde gebeurt als een case verwijderd
+        # wordt, daarom is er geen tegenhanger van deze functie.
+        if any(question_id not in answers for question_id in question_ids):
+            return
+        scores = np.array([int(answers[question_id]) for question_id in question_ids], dtype=np.int64)
+        sums, crossproducts = self.arrays()
+        self.n = (self.n or 0) + 1
+        self.sums = (sums + scores).tobytes()
+        self.crossproducts = (crossproducts + np.outer(scores, scores)).tobytes()
+
+    def arrays(self):
+        total_questions = len(self.question_ids())
+        sums = np.frombuffer(self.sums, dtype=np.int64)
+        crossproducts = np.frombuffer(self.crossproducts, dtype=np.int64).reshape(total_questions, total_questions)
+        return sums, crossproducts
+
+    def item_correlations(self):
+        question_ids = self.question_ids()
+        codes = dict(db.session.query(Question.id, Question.question_code).filter(Question.id.in_(question_ids)))
+        sums, crossproducts = self.arrays()
+        return ItemCorrelations.from_moments([codes[question_id] for question_id in question_ids], self.n, sums,
+                                             crossproducts)
+
+
+class AnalysisJob(db.Model):
+    # Een zware berekening (zoals het schatten van het PLS-PM model) die op de achtergrond uitgevoerd wordt, zie
+    # "app/jobs.py". De status, voortgang en het resultaat worden hier opgeslagen, zodat de pagina's het resultaat
+    # kunnen tonen zodra het klaar is en hetzelfde werk niet twee keer gedaan wordt. Per soort en sleutel is er maar één
+    # job (zie "enqueue_job").
+    __table_args__ = (db.UniqueConstraint('kind', 'key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), index=True)
+    key = db.Column(db.String(64), index=True)
+    status = db.Column(db.String(20), default='queued')
+    progress = db.Column(db.Float, default=0)
+    message = db.Column(db.String(200))
+    result = db.Column(db.LargeBinary(length=2 ** 32 - 1))
+    # Tussentijdse resultaten (als JSON), zodat de pagina deze al kan tonen terwijl de job nog loopt.
+    partial = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    finished = db.Column(db.DateTime)
+
+    questionnaire_id = db.Column(db.Integer, db.ForeignKey('questionnaire.id'))
+
+    def __repr__(self):
+        return '<Analysis job {} {} ({})>'.format(self.id, self.kind, self.status)
+
+    def is_finished(self):
+        return self.status == 'finished'
+
+    def is_failed(self):
+        return self.status == 'failed'
+
+    def update_progress(self, progress, message=None, partial=None):
+        self.progress = progress
+        self.message = message
+        if partial is not None:
+            self.partial = json.dumps(partial)
+        db.session.commit()
+
+    def set_result(self, result):
+        self.result = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_result(self):
+        return pickle.loads(self.result)
+
+    def as_dict(self):
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'progress': self.progress,
+                'message': self.message, 'error': self.error,
+                'partial': json.loads(self.partial) if self.partial is not None else None}
+
+
+class RelationSignificance(db.Model):
+    # De significantie van de padcoëfficiënt van een relatie, berekend met bootstrapping (zie
+    # "bootstrap_path_coefficients" binnen "create_study/functions.py"). De sleutel is die van de analyse, zodat
+    # opnieuw berekend wordt zodra de data of het model veranderd is.
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), index=True)
+    estimate = db.Column(db.Float)
+    std_error = db.Column(db.Float)
+    t_value = db.Column(db.Float)
+    p_value = db.Column(db.Float)
+    ci_lower = db.Column(db.Float)
+    ci_upper = db.Column(db.Float)
+    samples = db.Column(db.Integer)
+
+    relation_id = db.Column(db.Integer, db.ForeignKey('relation.id'))
+    questionnaire_id = db.Column(db.Integer, db.ForeignKey('questionnaire.id'))
+
+    def __repr__(self):
+        return '<Relation significance {} (t = {})>'.format(self.relation_id, self.t_value)
+
+    def return_relation(self):
+        return Relation.query.get(self.relation_id).return_relation()
+
+    def is_significant(self, alpha=0.05):
+        return self.p_value is not None and self.p_value < alpha
+
+
+class StoredSession(db.Model):
+    # De sessie van een bezoeker als SESSION_TYPE "database" is (zie "app/sessions.py"). De ID is de code uit de cookie;
+    # "expiry" heeft een index, zodat het opruimen van verlopen sessies niet de hele tabel hoeft te doorzoeken.
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary)
+    expiry = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<Session {} (expires {})>'.format(self.id, self.expiry)
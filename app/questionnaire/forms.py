@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField, RadioField, BooleanField
+from wtforms import StringField, SubmitField, TextAreaField, RadioField, BooleanField, HiddenField
+from wtforms.validators import DataRequired, UUID
 
 
 # Een dynamische veld waarmee meerdere Forms tegelijk opgeslagen kunnen worden. Deze wordt met name gebruikt binnen de
@@ -7,13 +8,19 @@ from wtforms import StringField, SubmitField, TextAreaField, RadioField, Boolean
 # de vragenlijst (zoals de hoeveelheid vragen binnen een kernvariabele en hoeveel demografische informatie opgeslagen)
 # door de gebruiker zelf bepaald worden en dus de hoeveelheid onbepaald is voor de programmeur voorafgaand.
 def QuestionnaireForm(questions, *args, **kwargs):
+    return questionnaire_form_class(questions)(*args, **kwargs)
+
+
+# De klasse van de dynamische Form. Deze kan één keer aangemaakt en daarna voor ieder verzoek opnieuw gebruikt worden
+# (zie "build_questionnaire_snapshot" binnen "questionnaire/functions.py"); de velden worden pas per Form gebonden.
+def questionnaire_form_class(questions):
     class TestForm(FlaskForm):
         submit = SubmitField('Go to next page')
 
     for name, value in questions.items():
         setattr(TestForm, name, value)
 
-    return TestForm(*args, **kwargs)
+    return TestForm
 
 
 # De Form welke gebruikt wordt voor enkel opslaan en verwijzen.
@@ -24,3 +31,20 @@ class SubmitForm(FlaskForm):
 # De knop om te starten met de vragenlijst.
 class StartQuestionnaireForm(FlaskForm):
     submit = SubmitField('Start questionnaire')
+
+
+# De Form voor de volledige vragenlijst op één pagina. "submission" is een willekeurige code die per keer dat de pagina
+# geopend wordt aangemaakt wordt, zodat een tweede keer verzenden van dezelfde pagina herkend wordt.
+class SinglePageForm(FlaskForm):
+    submission = HiddenField(validators=[DataRequired(), UUID()])
+    submit = SubmitField('Submit')
+
+
+def single_page_form_class(fields):
+    class QuestionnairePageForm(SinglePageForm):
+        pass
+
+    for name, value in fields.items():
+        setattr(QuestionnairePageForm, name, value)
+
+    return QuestionnairePageForm
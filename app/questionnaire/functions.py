@@ -1,5 +1,13 @@
-from app.models import Study
-from flask import render_template, flash, redirect, url_for, request
+import threading
+from collections import namedtuple
+from app import db
+from app.completions import complete_case
+from app.models import Study, Case, Questionnaire, QuestionGroup, Question
+from app.models import demographic_field
+from app.questionnaire.forms import questionnaire_form_class, single_page_form_class
+from flask import redirect, url_for, session, g
+from sqlalchemy.exc import IntegrityError
+from wtforms import RadioField
 
 
 # Het omdraaien van de score in het geval dat "reversed_score" geldt voor de vraag.
@@ -8,9 +16,159 @@ def reverse_value(value, scale):
     return str(new_value)
 
 
-def security_check(study_code):
-    # Checken of gebruiker tot betrokken onderzoekers hoort
-    study = Study.query.filter_by(code=study_code).first()
+def running_study(study_code):
+    # Het onderzoek, maar alleen als het loopt (stage_2); anders None. Het onderzoek wordt bij ieder verzoek opnieuw uit
+    # de database gelezen (zodat het starten of beëindigen direct in alle processen geldt) en binnen het verzoek
+    # bewaard in "g".
+    studies = g.setdefault('running_studies', {})
+    if study_code not in studies:
+        study = Study.query.filter_by(code=study_code).first()
+        studies[study_code] = study if study is not None and study.stage_2 else None
+    return studies[study_code]
+
 
-    if not study.stage_2:
+def security_check(study_code):
+    # Checken of het onderzoek loopt; zo niet, dan de redirect die de route moet returnen. Een eventuele momentopname
+    # van de vragenlijst wordt dan vergeten.
+    if running_study(study_code) is None:
+        forget_questionnaire_snapshot(study_code)
         return redirect(url_for('main.not_authorized'))
+
+
+def participant_case(questionnaire_id):
+    # De case van de participant binnen de vragenlijst van dit onderzoek, opgezocht via de (unieke en daarmee
+    # geïndexeerde) kolom "session" van Case in plaats van door alle cases te lopen. Binnen een verzoek wordt de case
+    # bewaard in "g", zodat deze maar één keer opgezocht wordt.
+    if "user" not in session:
+        return None
+    cases = g.setdefault('participant_cases', {})
+    if questionnaire_id not in cases:
+        cases[questionnaire_id] = Case.query.filter_by(session=session["user"],
+                                                       questionnaire_id=questionnaire_id).first()
+    return cases[questionnaire_id]
+
+
+# De vragenlijst van een lopend onderzoek (stage_2) verandert niet meer. De pagina's voor de participant gebruiken
+# daarom een onveranderlijke momentopname van de vragenlijst: het onderzoek, de schaal, de onderdelen (vragengroepen)
+# met hun vragen op volgorde en de demografieken. Deze wordt één keer opgebouwd (bij het starten van het onderzoek of
+# bij het eerste verzoek van een participant) en per proces bewaard per onderzoekscode, alleen zolang het onderzoek
+# loopt: bij ieder verzoek wordt eerst in de database gecontroleerd of dat nog zo is (zie "running_study"), zodat een
+# proces nooit een vragenlijst bewaart die nog kan veranderen of blijft tonen nadat het onderzoek beëindigd is. "offset" is de positie van de
+# eerste vraag van een onderdeel binnen alle vragen, gebruikt voor de scores in de sessie van de participant. De
+# klassen van de Forms (per onderdeel, voor de demografieken en voor de volledige vragenlijst op één pagina) worden ook
+# één keer aangemaakt, zodat een verzoek deze alleen nog hoeft te instantiëren.
+StudySnapshot = namedtuple('StudySnapshot', ['id', 'code', 'name', 'description'])
+QuestionSnapshot = namedtuple('QuestionSnapshot', ['id', 'question', 'question_code', 'reversed_score'])
+PartSnapshot = namedtuple('PartSnapshot', ['id', 'offset', 'questions', 'form'])
+DemographicSnapshot = namedtuple('DemographicSnapshot', ['id', 'name', 'questiontype', 'optional', 'options'])
+QuestionnaireSnapshot = namedtuple('QuestionnaireSnapshot', ['id', 'study', 'scale', 'parts', 'demographics',
+                                                             'demographics_form', 'single_page_form',
+                                                             'total_questions'])
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def build_questionnaire_snapshot(study):
+    questionnaire = Questionnaire.query.filter_by(study_id=study.id).first()
+    parts = []
+    offset = 0
+    single_page_fields = {}
+    for questiongroup in questionnaire.linked_questiongroups.order_by(QuestionGroup.id):
+        questions = tuple(QuestionSnapshot(question.id, question.question, question.question_code,
+                                           bool(question.reversed_score))
+                          for question in Question.query.filter_by(questiongroup_id=questiongroup.id).order_by(
+                              Question.id))
+        # Een dictionary met de vraag als key en een bijbehorende Field om in te vullen als waarde.
+        choices = [number for number in range(1, questionnaire.scale + 1)]
+        form = questionnaire_form_class({question.question: RadioField(question.question, choices=choices)
+                                         for question in questions})
+        parts.append(PartSnapshot(questiongroup.id, offset, questions, form))
+        single_page_fields.update({'question_{}'.format(question.id): RadioField(question.question, choices=choices)
+                                   for question in questions})
+        offset += len(questions)
+    demographics = tuple(DemographicSnapshot(demographic.id, demographic.name, demographic.questiontype,
+                                             demographic.optional, tuple(demographic.return_list_of_options()))
+                         for demographic in questionnaire.linked_demographics)
+    # Een dictionary met de demografieken en een "return field" zodat de gebruiker alle demografieken kan invullen.
+    demographics_form = questionnaire_form_class({
+        demographic.name: demographic_field(demographic.name, demographic.questiontype, demographic.optional,
+                                            demographic.options) for demographic in demographics})
+
+    # Op de pagina met de volledige vragenlijst hebben de velden het ID als naam, omdat een vraag dezelfde tekst kan
+    # hebben als een andere vraag of een demografiek.
+    single_page_fields.update({
+        'demographic_{}'.format(demographic.id): demographic_field(demographic.name, demographic.questiontype,
+                                                                   demographic.optional, demographic.options)
+        for demographic in demographics})
+
+    return QuestionnaireSnapshot(questionnaire.id, StudySnapshot(study.id, study.code, study.name, study.description),
+                                 questionnaire.scale, tuple(parts), demographics, demographics_form,
+                                 single_page_form_class(single_page_fields), offset)
+
+
+def cache_questionnaire_snapshot(snapshot):
+    with _snapshots_lock:
+        _snapshots[snapshot.study.code] = snapshot
+
+
+def forget_questionnaire_snapshot(study_code):
+    with _snapshots_lock:
+        _snapshots.pop(study_code, None)
+
+
+def questionnaire_snapshot(study_code):
+    # Returnt None (en vergeet een eventuele momentopname) als het onderzoek niet (meer) loopt.
+    study = running_study(study_code)
+    if study is None:
+        forget_questionnaire_snapshot(study_code)
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(study_code)
+    if snapshot is None or snapshot.study.id != study.id:
+        snapshot = build_questionnaire_snapshot(study)
+        cache_questionnaire_snapshot(snapshot)
+    return snapshot
+
+
+def answered_scores(snapshot, scores):
+    # De gegeven scores uit de sessie als dictionary met de vraag-ID als key en de score als waarde.
+    return {question.id: scores[part.offset + index] for part in snapshot.parts
+            for index, question in enumerate(part.questions) if scores[part.offset + index] != 0}
+
+
+def single_page_answers(snapshot, form):
+    # De antwoorden uit de Form van de volledige vragenlijst: de scores (met de omgedraaide score voor vragen met
+    # "reversed_score") als dictionary met de vraag-ID als key, en de demografische antwoorden als lijst met
+    # (demografiek-ID, antwoord).
+    scores = {}
+    for part in snapshot.parts:
+        for question in part.questions:
+            value = form['question_{}'.format(question.id)].data
+            if question.reversed_score:
+                value = reverse_value(value, snapshot.scale)
+            scores[question.id] = int(value)
+    demographic_answers = []
+    for demographic in snapshot.demographics:
+        answer = form['demographic_{}'.format(demographic.id)].data
+        demographic_answers.append((demographic.id, None if answer == [] or answer is None else answer))
+    return scores, demographic_answers
+
+
+def complete_submission(questionnaire, submission, scores, demographic_answers):
+    # Het in één transactie aanmaken en voltooien van de case van een volledig verzonden vragenlijst. De code van de
+    # verzending wordt gebruikt als sessie van de case, zodat een tweede keer verzenden (ook gelijktijdig) niets opnieuw
+    # opslaat; in dat geval wordt False gereturned.
+    case = Case.query.filter_by(session=submission).first()
+    if case is None:
+        case = Case(session=submission, questionnaire_id=questionnaire.id)
+        db.session.add(case)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+    elif case.questionnaire_id != questionnaire.id:
+        return False
+
+    return complete_case(case, questionnaire, scores, demographic_answers)
@@ -0,0 +1,209 @@
+import os
+import pickle
+import re
+import threading
+import time
+from datetime import datetime
+from flask_session.sessions import SessionInterface, ServerSideSession, \
+    FileSystemSessionInterface as FlaskFileSystemSessionInterface
+from itsdangerous import BadSignature, want_bytes
+from sqlalchemy import create_engine, event, select, insert, update, delete
+from app import db, session
+from app.models import StoredSession
+
+
+# Het bewaren van de sessies van de bezoekers, naar keuze (SESSION_TYPE) in bestanden of in een tabel van de database.
+# Bestanden zijn alleen te delen door de processen op één server; met een tabel kunnen meerdere servers dezelfde
+# sessies gebruiken. In beide gevallen verloopt een sessie na PERMANENT_SESSION_LIFETIME zonder gebruik. Verlopen
+# sessies worden iedere SESSION_GC_INTERVAL seconden door een thread op de achtergrond opgeruimd (en met
+# "flask sessions gc"), zodat ze zich niet onbeperkt ophopen en een verzoek van een participant er nooit op wacht.
+
+GC_BATCH_SIZE = 500
+# De bestanden van Flask-Session (cachelib) hebben de MD5-hash van de sleutel als naam; andere bestanden in de map
+# (zoals de teller van cachelib) worden niet opgeruimd of meegeteld.
+SESSION_FILE_NAME = re.compile(r'^[0-9a-f]{32}$')
+
+_collector = None
+_collector_lock = threading.Lock()
+
+
+class DatabaseSession(ServerSideSession):
+    # Het moment waarop de sessie in de database verloopt (None voor een nieuwe sessie).
+    expiry = None
+
+
+class DatabaseSessionInterface(SessionInterface):
+    serializer = pickle
+    session_class = DatabaseSession
+
+    def __init__(self, url=None, use_signer=False, permanent=True):
+        self.url = url
+        self.use_signer = use_signer
+        self.permanent = permanent
+        self.table = StoredSession.__table__
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
+    def engine(self, app):
+        # Zonder eigen URL staat de tabel in de database van de applicatie (en wordt deze met de migraties aangemaakt).
+        # Een eigen database, bijvoorbeeld een SQLite-bestand, krijgt de tabel bij het eerste gebruik.
+        with self._engine_lock:
+            if self._engine is None:
+                if self.url is None:
+                    self._engine = db.get_engine(app)
+                else:
+                    engine = create_engine(self.url)
+                    if engine.dialect.name == 'sqlite':
+                        event.listen(engine, 'connect', _sqlite_wal)
+                    self.table.create(engine, checkfirst=True)
+                    self._engine = engine
+            return self._engine
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and self.use_signer:
+            try:
+                sid = self._get_signer(app).unsign(sid).decode()
+            except BadSignature:
+                sid = None
+        if sid:
+            with self.engine(app).connect() as connection:
+                row = connection.execute(select(self.table.c.data, self.table.c.expiry).where(
+                    self.table.c.id == sid, self.table.c.expiry > datetime.utcnow())).first()
+            if row is not None:
+                try:
+                    stored = self.session_class(self.serializer.loads(row.data), sid=sid)
+                    stored.expiry = row.expiry
+                    return stored
+                except Exception:
+                    pass
+        # Een onbekende of verlopen sessie krijgt een nieuwe ID, zodat een ID uit een cookie nooit overgenomen wordt.
+        return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                with self.engine(app).begin() as connection:
+                    connection.execute(delete(self.table).where(self.table.c.id == session.sid))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        # Een ongewijzigde sessie wordt alleen opnieuw opgeslagen (om het verlopen uit te stellen) als deze al over de
+        # helft van de levensduur is; de meeste verzoeken die de sessie alleen lezen schrijven dus niets.
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        if not session.modified and session.expiry is not None and session.expiry - now > lifetime / 2:
+            return
+
+        values = {'data': self.serializer.dumps(dict(session), protocol=pickle.HIGHEST_PROTOCOL),
+                  'expiry': now + lifetime}
+        with self.engine(app).begin() as connection:
+            if connection.execute(update(self.table).where(self.table.c.id == session.sid).values(
+                    **values)).rowcount == 0:
+                connection.execute(insert(self.table).values(id=session.sid, **values))
+        session.expiry = values['expiry']
+
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(want_bytes(session.sid))
+        else:
+            session_id = session.sid
+        response.set_cookie(app.session_cookie_name, session_id, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def collect_garbage(self, app):
+        # Het verwijderen van de verlopen sessies, in batches zodat de tabel nooit lang vergrendeld is. Returnt het
+        # aantal verwijderde sessies.
+        removed = 0
+        engine = self.engine(app)
+        while True:
+            with engine.begin() as connection:
+                expired = connection.execute(select(self.table.c.id).where(
+                    self.table.c.expiry <= datetime.utcnow()).limit(GC_BATCH_SIZE)).scalars().all()
+                if len(expired) > 0:
+                    connection.execute(delete(self.table).where(self.table.c.id.in_(expired)))
+            removed += len(expired)
+            if len(expired) < GC_BATCH_SIZE:
+                return removed
+
+    def count_sessions(self, app):
+        with self.engine(app).connect() as connection:
+            return connection.execute(select(db.func.count()).select_from(self.table)).scalar()
+
+
+class FileSystemSessionInterface(FlaskFileSystemSessionInterface):
+    # De bestanden van Flask-Session, aangevuld met het opruimen van de verlopen sessies. Zonder opruimen worden
+    # verlopen bestanden pas verwijderd als er meer dan SESSION_FILE_THRESHOLD zijn, en worden daarna bij ieder
+    # opgeslagen verzoek alle bestanden doorzocht. Een bestand wordt bij iedere opgeslagen sessie opnieuw geschreven;
+    # een bestand dat langer dan de levensduur niet gewijzigd is, is dus verlopen.
+    def __init__(self, cache_dir, *args, **kwargs):
+        super().__init__(cache_dir, *args, **kwargs)
+        self.cache_dir = cache_dir
+
+    def session_files(self):
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and SESSION_FILE_NAME.match(entry.name):
+                    yield entry
+
+    def collect_garbage(self, app):
+        expired = time.time() - app.permanent_session_lifetime.total_seconds()
+        removed = 0
+        for entry in self.session_files():
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # Tegelijk door een ander proces opgeruimd of verwijderd.
+                pass
+        return removed
+
+    def count_sessions(self, app):
+        return sum(1 for _ in self.session_files())
+
+
+def _sqlite_wal(connection, record):
+    # Met WAL kunnen meerdere processen tegelijk sessies lezen terwijl er één schrijft.
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+
+def init_session_store(app):
+    config = app.config
+    if config['SESSION_TYPE'] == 'database':
+        app.session_interface = DatabaseSessionInterface(
+            config['SESSION_DATABASE_URL'], config.get('SESSION_USE_SIGNER', False), config['SESSION_PERMANENT'])
+    else:
+        # De overige soorten van Flask-Session (zoals "redis") blijven ook beschikbaar.
+        session.init_app(app)
+        if config['SESSION_TYPE'] == 'filesystem':
+            # Flask-Session vult zijn standaardwaarden niet in de configuratie van de app in.
+            app.session_interface = FileSystemSessionInterface(
+                config['SESSION_FILE_DIR'], config['SESSION_FILE_THRESHOLD'], config.get('SESSION_FILE_MODE', 0o600),
+                config.get('SESSION_KEY_PREFIX', 'session:'), config.get('SESSION_USE_SIGNER', False),
+                config['SESSION_PERMANENT'])
+
+    # De opruimthread wordt bij het eerste verzoek gestart, dus niet voor de procesworkers of de commando's.
+    if config['SESSION_GC_INTERVAL'] > 0 and hasattr(app.session_interface, 'collect_garbage'):
+        app.before_first_request(lambda: start_collector(app))
+
+
+def start_collector(app):
+    # De thread die verlopen sessies opruimt, één per proces.
+    global _collector
+    with _collector_lock:
+        if _collector is None or not _collector.is_alive():
+            _collector = threading.Thread(target=_collect_forever, args=(app,), name='session-collector', daemon=True)
+            _collector.start()
+
+
+def _collect_forever(app):
+    while True:
+        time.sleep(app.config['SESSION_GC_INTERVAL'])
+        try:
+            app.session_interface.collect_garbage(app)
+        except Exception:
+            app.logger.exception('Removing the expired sessions failed')
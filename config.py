@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -17,3 +18,41 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # Het aantal processen voor de achtergrondberekeningen (0 voert deze direct binnen het verzoek uit) en na hoeveel
+    # seconden een onafgemaakte berekening opnieuw gestart wordt.
+    ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS') or 2)
+    ANALYSIS_JOB_TIMEOUT = int(os.environ.get('ANALYSIS_JOB_TIMEOUT') or 1800)
+    # Het aantal afgeronde berekeningen dat per vragenlijst en soort bewaard wordt; oudere worden verwijderd.
+    ANALYSIS_JOB_HISTORY = int(os.environ.get('ANALYSIS_JOB_HISTORY') or 5)
+    # Het aantal bootstrap-steekproeven voor de significantie van de padcoëfficiënten en hoeveel daarvan per batch
+    # binnen één proces berekend worden.
+    BOOTSTRAP_SAMPLES = int(os.environ.get('BOOTSTRAP_SAMPLES') or 5000)
+    BOOTSTRAP_BATCH_SIZE = int(os.environ.get('BOOTSTRAP_BATCH_SIZE') or 250)
+    # Het aantal permutaties (en per batch) voor het vergelijken van groepen, en het minimale aantal cases per groep.
+    PERMUTATIONS = int(os.environ.get('PERMUTATIONS') or 1000)
+    PERMUTATION_BATCH_SIZE = int(os.environ.get('PERMUTATION_BATCH_SIZE') or 100)
+    MINIMUM_GROUP_SIZE = int(os.environ.get('MINIMUM_GROUP_SIZE') or 30)
+    # Het aantal cases per deel van de tabellen met resultaten op de samenvattingspagina.
+    RESULTS_PAGE_SIZE = int(os.environ.get('RESULTS_PAGE_SIZE') or 100)
+    # De map waarin de rapporten van de data-analyse bewaard worden, per versie van de data en het model.
+    REPORT_FOLDER = os.environ.get('REPORT_FOLDER') or os.path.join(basedir, 'reports')
+    # De vragenlijst op één pagina tonen (met één keer verzenden aan het einde) in plaats van per vragengroep.
+    SINGLE_PAGE_QUESTIONNAIRE = os.environ.get('SINGLE_PAGE_QUESTIONNAIRE') is not None
+    # Het SQLite-bestand waarin voltooide vragenlijsten eerst lokaal opgeslagen worden, waarna ze op de achtergrond in
+    # batches naar de database geschreven worden (zie "app/completions.py"). Zonder bestand worden ze direct opgeslagen.
+    COMPLETION_QUEUE = os.environ.get('COMPLETION_QUEUE')
+    COMPLETION_FLUSH_INTERVAL = float(os.environ.get('COMPLETION_FLUSH_INTERVAL') or 1)
+    COMPLETION_BATCH_SIZE = int(os.environ.get('COMPLETION_BATCH_SIZE') or 200)
+    # Waar de sessies van de bezoekers bewaard worden (zie "app/sessions.py"): "filesystem" (bestanden in
+    # SESSION_FILE_DIR, alleen te delen door processen op dezelfde server) of "database" (een tabel, te delen door alle
+    # servers). Met SESSION_DATABASE_URL staat de tabel in een eigen database, bijvoorbeeld een SQLite-bestand.
+    SESSION_TYPE = os.environ.get('SESSION_TYPE') or 'filesystem'
+    SESSION_PERMANENT = False
+    SESSION_DATABASE_URL = os.environ.get('SESSION_DATABASE_URL')
+    SESSION_FILE_DIR = os.environ.get('SESSION_FILE_DIR') or os.path.join(basedir, 'flask_session')
+    # Boven dit aantal bestanden verwijdert Flask-Session de oudste sessies, ook als deze nog in gebruik zijn.
+    SESSION_FILE_THRESHOLD = int(os.environ.get('SESSION_FILE_THRESHOLD') or 10000)
+    # Na hoeveel seconden zonder gebruik een sessie verloopt, en om de hoeveel seconden de verlopen sessies op de
+    # achtergrond opgeruimd worden (0 alleen met "flask sessions gc").
+    PERMANENT_SESSION_LIFETIME = timedelta(seconds=int(os.environ.get('SESSION_LIFETIME') or 86400))
+    SESSION_GC_INTERVAL = float(os.environ.get('SESSION_GC_INTERVAL') or 600)